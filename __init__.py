@@ -8,6 +8,7 @@ try:
     from .ratio_crop_with_panel import RatioCropWithPanel
     from .curve_adjust import CurvePanel
     from .levelssss import LevelsPanel
+    from .color_lut import ApplyColorLUT, SaveColorLUTCube, LoadCubeLUT
 
     # 节点类映射
     NODE_CLASS_MAPPINGS = {
@@ -18,6 +19,9 @@ try:
         "RatioCropWithPanel": RatioCropWithPanel,
         "CurvePanel": CurvePanel,
         "levelssss": LevelsPanel,
+        "ApplyColorLUT": ApplyColorLUT,
+        "SaveColorLUTCube": SaveColorLUTCube,
+        "LoadCubeLUT": LoadCubeLUT,
     }
 
     # 节点显示名称
@@ -29,6 +33,9 @@ try:
         "RatioCropWithPanel": "🔵BB比例裁剪",
         "CurvePanel": "🔵BB曲线调整（交互）",
         "levelssss": "🔵BB色阶调整（交互）",
+        "ApplyColorLUT": "🔵BB应用颜色LUT",
+        "SaveColorLUTCube": "🔵BB保存.cube LUT",
+        "LoadCubeLUT": "🔵BB加载.cube LUT",
     }
 
     # 指定前端JS文件目录
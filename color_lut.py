@@ -0,0 +1,409 @@
+import os
+import uuid
+import hashlib
+import weakref
+import functools
+import torch
+import torch.nn.functional as F
+import numpy as np
+from .image_utils import as_batch, rgb_channels
+from .lut_utils import apply_float_luts_tensor, map_strips
+from .preview_utils import get_preview_proxy
+from .result_cache import cached_result, inputs_fingerprint
+
+try:
+    import folder_paths
+except ImportError:
+    # 脱离 ComfyUI 运行时，相对路径以当前目录为准
+    folder_paths = None
+
+
+# 三维 LUT 每次采样的像素数（限制 grid_sample 的临时内存）
+_CUBE_PIXEL_CHUNK = 1 << 18
+
+# 已解析 .cube 文件的缓存容量（按路径 + 修改时间）
+CUBE_CACHE_SIZE = 32
+
+# 未连接 image 时输出的灰阶渐变条尺寸（宽 x 高）
+LUT_STRIP_SIZE = (256, 16)
+
+# 调色链输出图像 -> 已应用的调色级标识（按对象 id，弱引用校验），用于发现重复应用
+_graded_outputs = {}
+
+
+class ColorLUT:
+    """
+    三通道一维颜色查找表（节点间传递的 COLOR_LUT 类型）
+    tables: float32 [3, N]，把 0-1 输入均匀采样为 N 点映射到 0-1 输出
+    多级曲线/色阶可在表上代数组合，最终只对图像做一次像素遍历
+    """
+
+    def __init__(self, tables, stages=()):
+        self.tables = np.ascontiguousarray(tables, dtype=np.float32)
+        self.tables.flags.writeable = False
+        # 组成该 LUT 的各级调色的标识（每次构建唯一），用于发现同一级被应用两次
+        self.stages = tuple(stages)
+
+    @classmethod
+    def from_luts(cls, lut_r, lut_g, lut_b):
+        """由三通道查找表构建（uint8 表按 /255 归一化，浮点表直接使用）"""
+        tables = np.stack([lut_r, lut_g, lut_b]).astype(np.float32)
+        if np.asarray(lut_r).dtype == np.uint8:
+            tables /= 255.0
+        return cls(tables, (uuid.uuid4().hex,))
+
+    @property
+    def size(self):
+        return self.tables.shape[1]
+
+    def fingerprint(self):
+        """查找表内容的指纹（用于结果缓存键）"""
+        return hashlib.blake2b(self.tables.tobytes(), digest_size=16).hexdigest()
+
+    def resample(self, size):
+        """将查找表重采样为 size 项（线性插值）"""
+        if size == self.size:
+            return self
+        grid = np.linspace(0.0, 1.0, size)
+        src_grid = np.linspace(0.0, 1.0, self.size)
+        return ColorLUT(np.stack([np.interp(grid, src_grid, t) for t in self.tables]), self.stages)
+
+    def then(self, other):
+        """组合：先应用 self，再应用 other，返回新的 ColorLUT（取两者中较高的采样精度）"""
+        first = self.resample(max(self.size, other.size))
+        other_grid = np.linspace(0.0, 1.0, other.size)
+        return ColorLUT(np.stack([
+            np.interp(first.tables[c], other_grid, other.tables[c]) for c in range(3)
+        ]), self.stages + other.stages)
+
+    def apply(self, images):
+        """对 IMAGE 批次一次性应用（线性插值，不做 8 位量化）"""
+        return apply_float_luts_tensor(as_batch(images), *self.tables)
+
+    def to_cube(self, title="BB LUT", lut_3d_size=None):
+        """
+        导出为标准 .cube 文本
+        lut_3d_size 为 None 时导出一维 LUT（LUT_1D_SIZE），否则导出 lut_3d_size^3 的三维 LUT
+        """
+        lines = [f'TITLE "{title}"', "DOMAIN_MIN 0.0 0.0 0.0", "DOMAIN_MAX 1.0 1.0 1.0"]
+        if lut_3d_size is None:
+            lines.insert(1, f"LUT_1D_SIZE {self.size}")
+            rows = self.tables.T
+        else:
+            lines.insert(1, f"LUT_3D_SIZE {lut_3d_size}")
+            axis = self.resample(lut_3d_size).tables
+            # .cube 三维数据按 R 变化最快、B 变化最慢的顺序排列
+            b, g, r = np.meshgrid(np.arange(lut_3d_size), np.arange(lut_3d_size), np.arange(lut_3d_size), indexing="ij")
+            rows = np.stack([axis[0][r.ravel()], axis[1][g.ravel()], axis[2][b.ravel()]], axis=1)
+        body = "\n".join(f"{v[0]:.6f} {v[1]:.6f} {v[2]:.6f}" for v in rows)
+        return "\n".join(lines) + "\n" + body + "\n"
+
+
+def lut_strip():
+    """0-1 的水平灰阶渐变条 [1, h, w, 3]，用于在没有图像时显示 LUT 的效果"""
+    width, height = LUT_STRIP_SIZE
+    ramp = torch.linspace(0.0, 1.0, width)
+    return ramp.view(1, 1, width, 1).expand(1, height, width, 3).contiguous()
+
+
+def mark_graded(images, color_lut):
+    """记录 images 已应用了 color_lut 的各级调色"""
+    for key in [k for k, v in _graded_outputs.items() if v[0]() is None]:
+        del _graded_outputs[key]
+    _graded_outputs[id(images)] = (weakref.ref(images), frozenset(color_lut.stages))
+
+
+def check_chain_input(images, color_lut):
+    """
+    调色链的 image 必须是原始输入：若 images 是本链中某一级的输出（已应用过 color_lut 中的调色），
+    再应用整条链会重复调色，直接报错
+    """
+    entry = _graded_outputs.get(id(images))
+    if entry is not None and entry[0]() is images and entry[1] & set(color_lut.stages):
+        raise ValueError("image 已经应用过 color_lut 中的调色：接入 color_lut 时 image 应连接调色链的原始图像，"
+                         "而不是上一级的 output_image")
+
+
+def grade_stage(image, color_lut, stage_lut, apply_stage):
+    """
+    曲线/色阶节点共用的调色链流程，返回 (output_image, preview_image, color_lut)
+    - 本级 LUT 与上游 LUT 组合（先上游，后本级）
+    - 未接入上游 LUT 时用 apply_stage 应用本级查找表；接入时把整条链一次应用到原始图像
+    - 未连接 image 时不做任何像素遍历，只输出组合后的 LUT（两个图像输出为 LUT 作用后的灰阶渐变条），
+      链中间级不连接 image、只在最后一级（或「应用颜色LUT」节点）连接原始图像，整条链只遍历一次像素
+    """
+    chain_lut = stage_lut if color_lut is None else color_lut.then(stage_lut)
+
+    def apply_chain(frames):
+        return apply_stage(frames) if color_lut is None else chain_lut.apply(frames)
+
+    if image is None:
+        strip = apply_chain(lut_strip())
+        return (strip, strip, chain_lut)
+
+    if color_lut is not None:
+        check_chain_input(image, color_lut)
+    batch = as_batch(image)
+    out_tensor = apply_chain(batch)
+    mark_graded(out_tensor, chain_lut)
+
+    # 预览：只对缓存的第一帧缩小代理图应用查找表，与原图分辨率无关
+    preview_tensor = apply_chain(get_preview_proxy(batch))
+    return (out_tensor, preview_tensor, chain_lut)
+
+
+class CubeLUT:
+    """
+    解析后的 .cube 查找表
+    kind: "1D" 时 table 为 [N, 3]；"3D" 时 table 为 [N, N, N, 3]（按 [b][g][r] 索引）
+    """
+
+    def __init__(self, kind, table, domain_min, domain_max):
+        self.kind = kind
+        self.table = table
+        self.domain_min = np.asarray(domain_min, dtype=np.float32)
+        self.domain_max = np.asarray(domain_max, dtype=np.float32)
+
+    @property
+    def size(self):
+        return self.table.shape[0]
+
+    def normalize_input(self, rgb):
+        """按 DOMAIN_MIN/MAX 将输入映射到 0-1"""
+        low = torch.from_numpy(self.domain_min)
+        span = torch.from_numpy(np.maximum(self.domain_max - self.domain_min, 1e-12))
+        return ((rgb - low) / span).clamp_(0, 1)
+
+    def apply(self, images):
+        """对 IMAGE 批次 [B, H, W, C] 应用 LUT，按横向条带处理，返回 float32 [B, H, W, 3]"""
+        images = as_batch(images)
+        has_domain = np.any(self.domain_min != 0) or np.any(self.domain_max != 1)
+        if self.kind == "1D" and not has_domain:
+            return apply_float_luts_tensor(images, *self.table.T)
+
+        if self.kind == "3D":
+            # [N(b), N(g), N(r), 3] -> [1, 3, D=b, H=g, W=r]
+            volume = torch.from_numpy(np.ascontiguousarray(self.table.transpose(3, 0, 1, 2)))[None]
+
+        def process(pixels, dst):
+            rgb = rgb_channels(pixels)
+            rgb = rgb.float() / 255.0 if rgb.dtype == torch.uint8 else rgb.float()
+            if self.kind == "1D":
+                dst.copy_(apply_float_luts_tensor(self.normalize_input(rgb), *self.table.T))
+            else:
+                self.sample_3d(volume, rgb, dst)
+
+        return map_strips(images, process)
+
+    def sample_3d(self, volume, pixels, dst):
+        """三线性插值：整张 LUT 作为 5D 体数据，分块用 grid_sample 采样 [N, 3] 像素写入 dst"""
+        total = pixels.shape[0]
+        for start in range(0, total, _CUBE_PIXEL_CHUNK):
+            end = min(total, start + _CUBE_PIXEL_CHUNK)
+            # grid 最后一维为 (x=r, y=g, z=b)，align_corners=True 时 -1/1 对应首尾格点
+            grid = self.normalize_input(pixels[start:end]).mul_(2.0).sub_(1.0)
+            sampled = F.grid_sample(volume, grid.view(1, 1, 1, -1, 3), mode="bilinear",
+                                    padding_mode="border", align_corners=True)
+            dst[start:end] = sampled.view(3, -1).T
+
+
+def parse_cube(text):
+    """
+    解析 .cube 文本（支持 LUT_1D_SIZE / LUT_3D_SIZE / DOMAIN_MIN / DOMAIN_MAX，
+    以及 Resolve 格式的 LUT_1D_INPUT_RANGE / LUT_3D_INPUT_RANGE：三个通道共用的输入范围，
+    按 LUT 类型取对应的一项；同时给出 DOMAIN_MIN/MAX 时以 DOMAIN 为准）
+    """
+    kind = None
+    size = 0
+    domain_min = domain_max = None
+    input_ranges = {}
+    values = []
+    for raw in text.splitlines():
+        line = raw.strip()
+        if not line or line.startswith("#"):
+            continue
+        key = line.split()[0].upper()
+        if key == "TITLE":
+            continue
+        if key == "LUT_1D_SIZE":
+            kind, size = "1D", int(line.split()[1])
+        elif key == "LUT_3D_SIZE":
+            kind, size = "3D", int(line.split()[1])
+        elif key == "DOMAIN_MIN":
+            domain_min = [float(v) for v in line.split()[1:4]]
+        elif key == "DOMAIN_MAX":
+            domain_max = [float(v) for v in line.split()[1:4]]
+        elif key in ("LUT_1D_INPUT_RANGE", "LUT_3D_INPUT_RANGE"):
+            low, high = (float(v) for v in line.split()[1:3])
+            input_ranges[key[4:6]] = ([low] * 3, [high] * 3)
+        elif key[0].isdigit() or key[0] in "+-.":
+            values.append(line.split()[:3])
+        # 其他关键字忽略
+
+    if kind is None or size < 2:
+        raise ValueError("无效的 .cube 文件：缺少 LUT_1D_SIZE / LUT_3D_SIZE")
+    table = np.asarray(values, dtype=np.float32)
+    expected = size if kind == "1D" else size ** 3
+    if table.shape != (expected, 3):
+        raise ValueError(f"无效的 .cube 文件：期望 {expected} 行数据，实际 {len(table)} 行")
+    if kind == "3D":
+        table = table.reshape(size, size, size, 3)
+    table.flags.writeable = False
+
+    range_min, range_max = input_ranges.get(kind, ([0.0] * 3, [1.0] * 3))
+    return CubeLUT(kind, table, range_min if domain_min is None else domain_min,
+                   range_max if domain_max is None else domain_max)
+
+
+@functools.lru_cache(maxsize=CUBE_CACHE_SIZE)
+def _load_cube_cached(path, mtime_ns, file_size):
+    with open(path, "r", encoding="utf-8-sig") as f:
+        return parse_cube(f.read())
+
+
+def load_cube(path):
+    """读取 .cube 文件；按 (路径, 修改时间, 大小) 缓存解析结果，文件改动后自动重新解析"""
+    stat = os.stat(path)
+    return _load_cube_cached(os.path.abspath(path), stat.st_mtime_ns, stat.st_size)
+
+
+def resolve_lut_path(path, for_writing=False):
+    """相对路径以 ComfyUI 输出目录为基准（不在 ComfyUI 中运行时为当前目录）"""
+    path = os.path.expanduser(path.strip().strip('"'))
+    if not os.path.isabs(path):
+        base = folder_paths.get_output_directory() if folder_paths is not None else os.getcwd()
+        path = os.path.join(base, path)
+    if for_writing and not path.lower().endswith(".cube"):
+        path += ".cube"
+    return path
+
+
+class ApplyColorLUT:
+    """
+    应用颜色 LUT 节点
+    将曲线/色阶节点输出的合成 COLOR_LUT 一次性应用到图像上
+    """
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                # 调色链的原始图像（不能是链中某一级的 output_image，否则会重复调色）
+                "image": ("IMAGE",),
+                "color_lut": ("COLOR_LUT",),
+            }
+        }
+
+    RETURN_TYPES = ("IMAGE",)
+    RETURN_NAMES = ("output_image",)
+    FUNCTION = "apply_lut"
+    CATEGORY = "🔵BB image crop"
+
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        """控件值的指纹（ComfyUI 调用时只传入控件值，不含连线输入；连线输入是否变化由 ComfyUI 按上游节点判断）"""
+        return inputs_fingerprint(kwargs)
+
+    @cached_result
+    def apply_lut(self, image, color_lut):
+        """整个批次只做一次像素遍历"""
+        check_chain_input(image, color_lut)
+        out_tensor = color_lut.apply(image)
+        mark_graded(out_tensor, color_lut)
+        return (out_tensor,)
+
+
+class SaveColorLUTCube:
+    """
+    烘焙 .cube LUT 节点
+    将曲线/色阶节点输出的 COLOR_LUT 保存为标准 .cube 文件（一维或三维）
+    """
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "color_lut": ("COLOR_LUT",),
+                "filename": ("STRING", {
+                    "default": "luts/bb_grade.cube",
+                    "multiline": False
+                }),
+                "lut_type": (["1D", "3D"], {
+                    "default": "1D"
+                }),
+                "lut_3d_size": ("INT", {
+                    "default": 33,
+                    "min": 2,
+                    "max": 129,
+                    "step": 1
+                }),
+            }
+        }
+
+    RETURN_TYPES = ("STRING",)
+    RETURN_NAMES = ("cube_path",)
+    FUNCTION = "save_cube"
+    OUTPUT_NODE = True
+    CATEGORY = "🔵BB image crop"
+
+    def save_cube(self, color_lut, filename, lut_type, lut_3d_size):
+        path = resolve_lut_path(filename, for_writing=True)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        title = os.path.splitext(os.path.basename(path))[0]
+        text = color_lut.to_cube(title, lut_3d_size if lut_type == "3D" else None)
+        with open(path, "w", encoding="utf-8") as f:
+            f.write(text)
+        return (path,)
+
+
+class LoadCubeLUT:
+    """
+    加载并应用 .cube LUT 节点
+    支持一维与三维（三线性插值）LUT，整个批次向量化处理；解析结果按路径与修改时间缓存
+    """
+
+    @classmethod
+    def INPUT_TYPES(cls):
+        return {
+            "required": {
+                "image": ("IMAGE",),
+                "cube_path": ("STRING", {
+                    "default": "luts/bb_grade.cube",
+                    "multiline": False
+                }),
+            }
+        }
+
+    RETURN_TYPES = ("IMAGE",)
+    RETURN_NAMES = ("output_image",)
+    FUNCTION = "apply_cube"
+    CATEGORY = "🔵BB image crop"
+
+    @classmethod
+    def IS_CHANGED(cls, cube_path, **kwargs):
+        """控件值的指纹，另外包含 .cube 文件的修改时间/大小：文件被修改时也视为改变"""
+        path = resolve_lut_path(cube_path)
+        try:
+            stat = os.stat(path)
+            file_state = (stat.st_mtime_ns, stat.st_size)
+        except OSError:
+            file_state = None
+        return inputs_fingerprint(dict(kwargs, cube_path=path, file_state=file_state))
+
+    def apply_cube(self, image, cube_path):
+        # 解析结果按文件修改时间缓存；不使用结果缓存，文件改动后必须重新应用
+        lut = load_cube(resolve_lut_path(cube_path))
+        return (lut.apply(image),)
+
+
+NODE_CLASS_MAPPINGS = {
+    "ApplyColorLUT": ApplyColorLUT,
+    "SaveColorLUTCube": SaveColorLUTCube,
+    "LoadCubeLUT": LoadCubeLUT,
+}
+
+NODE_DISPLAY_NAME_MAPPINGS = {
+    "ApplyColorLUT": "🔵BB应用颜色LUT",
+    "SaveColorLUTCube": "🔵BB保存.cube LUT",
+    "LoadCubeLUT": "🔵BB加载.cube LUT",
+}
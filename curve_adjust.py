@@ -1,7 +1,9 @@
-import torch
 import numpy as np
-from PIL import Image
 import json
+import functools
+from .lut_utils import apply_luts_tensor, FLOAT_LUT_SIZE
+from .color_lut import ColorLUT, grade_stage
+from .result_cache import cached_result, inputs_fingerprint
 
 class CurvePanel:
     """
@@ -13,7 +15,6 @@ class CurvePanel:
     def INPUT_TYPES(cls):
         return {
             "required": {
-                "image": ("IMAGE",),
                 "channel": ("STRING", {
                     "default": "RGB",
                     "choices": ["RGB", "R", "G", "B"]
@@ -23,268 +24,216 @@ class CurvePanel:
                     "default": "0,0;64,64;128,128;192,192;255,255",
                     "display": "hidden"
                 }),
+            },
+            "optional": {
+                # 待调色的图像：接入 color_lut 时必须是调色链的原始图像（连接上一级的 output_image 会重复调色，直接报错）；
+                # 不连接时只组合 LUT、不处理像素，链中间级留空即可让整条链只遍历一次像素
+                "image": ("IMAGE",),
+                # 8bit: 256 项查找表（与面板预览一致）；float: 高精度浮点查找表，直接插值浮点图像
+                "lut_precision": (["8bit", "float"], {
+                    "default": "8bit"
+                }),
+                # 上游曲线/色阶节点输出的合成 LUT；接入后 image 视为整条调色链的原始输入，
+                # 本节点把上游 LUT 与本级组合后只对图像做一次像素遍历
+                "color_lut": ("COLOR_LUT",),
             }
         }
 
-    RETURN_TYPES = ("IMAGE", "IMAGE")
-    RETURN_NAMES = ("output_image", "preview_image")
+    RETURN_TYPES = ("IMAGE", "IMAGE", "COLOR_LUT")
+    RETURN_NAMES = ("output_image", "preview_image", "color_lut")
     FUNCTION = "adjust_image"
     CATEGORY = "🔵BB image crop"
 
-    def adjust_image(self, image, channel="RGB", curve_points="0,0;64,64;128,128;192,192;255,255"):
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        """控件值的指纹（ComfyUI 调用时只传入控件值，不含连线输入；连线输入是否变化由 ComfyUI 按上游节点判断）"""
+        return inputs_fingerprint(kwargs)
+
+    @cached_result
+    def adjust_image(self, channel="RGB", curve_points="0,0;64,64;128,128;192,192;255,255", lut_precision="8bit", color_lut=None, image=None):
         """
-        应用曲线调整并返回结果与预览（预览为应用曲线后的缩小图）
+        应用曲线调整并返回结果、预览（预览为应用曲线后的缩小图）与合成后的 COLOR_LUT
         """
-        # 转换到PIL
-        if len(image.shape) == 4:
-            pil_image = self.tensor_to_pil(image[0])
-        else:
-            pil_image = self.tensor_to_pil(image)
 
         # 解析曲线参数并生成映射表
-        lut_r, lut_g, lut_b = self.build_luts_from_points(curve_points, channel)
-
-        # 应用查找表
-        result = self.apply_luts(pil_image, lut_r, lut_g, lut_b)
-
-        # 生成预览图（缩小）
-        preview = result.copy()
-        preview.thumbnail((min(512, preview.width), min(512, preview.height)), Image.Resampling.LANCZOS)
-
-        # 转换回tensor
-        out_tensor = self.pil_to_tensor(result)
-        preview_tensor = self.pil_to_tensor(preview)
+        lut_size = FLOAT_LUT_SIZE if lut_precision == "float" else None
+        lut_r, lut_g, lut_b = self.build_luts_from_points(curve_points, channel, lut_size)
 
-        return (out_tensor, preview_tensor)
+        # 未接入上游 LUT 时直接在 tensor 上对整个批次应用本级查找表
+        stage_lut = ColorLUT.from_luts(lut_r, lut_g, lut_b)
+        return grade_stage(image, color_lut, stage_lut, lambda frames: self.apply_luts(frames, lut_r, lut_g, lut_b))
 
-    def build_luts_from_points(self, points_str, channel):
+    def build_luts_from_points(self, points_str, channel, lut_size=None):
         """
         将点串解析为三通道的查找表（0-255）
         支持单通道或RGB整体调整
+        lut_size 为 None 时返回 256 项 uint8 查找表；
+        为整数时返回 lut_size 项 float32 查找表（0-1，不做 8 位量化）
+        相同曲线（规范化后）的编译结果走 LRU 缓存，重复执行只需一次字典查找
         """
-        # 支持两种格式：
-        # 1) 传统单通道字符串 "x0,y0;x1,y1;..."
-        # 2) JSON 字符串 {"RGB":"...","R":"...","G":"...","B":"..."} 表示每个通道的点串
-        def parse_points_list(s):
-            pts = []
-            try:
-                for part in s.split(';'):
-                    ss = part.strip()
-                    if not ss:
-                        continue
-                    x_str, y_str = ss.split(',')
-                    x = int(float(x_str))
-                    y = int(float(y_str))
-                    x = max(0, min(255, x))
-                    y = max(0, min(255, y))
-                    pts.append((x, y))
-            except Exception:
-                pts = [(0, 0), (255, 255)]
-            if pts[0][0] != 0:
-                pts.insert(0, (0, 0))
-            if pts[-1][0] != 255:
-                pts.append((255, 255))
-            xs = np.array([p[0] for p in pts], dtype=np.float64)
-            ys = np.array([p[1] for p in pts], dtype=np.float64)
-            return xs, ys
-
-        # 使用自然三次样条进行平滑插值（比线性更接近 Photoshop 曲线）
-        def natural_cubic_spline_interpolate(xs, ys, xq):
-            """
-            基于 Numerical Recipes 的自然三次样条实现。
-            xs, ys: 已排序的节点，xq: 查询点数组
-            返回对应的插值结果（float array）
-            """
-            n = len(xs)
-            if n < 2:
-                return np.zeros_like(xq, dtype=np.float64)
-
-            # 计算二阶导数 y2
-            y2 = np.zeros(n, dtype=np.float64)
-            u = np.zeros(n-1, dtype=np.float64)
-            y2[0] = 0.0
-            u[0] = 0.0
-            for i in range(1, n-1):
-                sig = (xs[i] - xs[i-1]) / (xs[i+1] - xs[i-1])
-                p = sig * y2[i-1] + 2.0
-                if p == 0:
-                    y2[i] = 0.0
-                    u[i] = 0.0
-                else:
-                    y2[i] = (sig - 1.0) / p
-                    denom = (xs[i+1] - xs[i-1])
-                    if denom == 0:
-                        u[i] = 0.0
-                    else:
-                        u[i] = (6.0 * ((ys[i+1]-ys[i])/(xs[i+1]-xs[i]) - (ys[i]-ys[i-1])/(xs[i]-xs[i-1])) / denom - sig * u[i-1]) / p
-            y2[-1] = 0.0
-            for k in range(n-2, -1, -1):
-                y2[k] = y2[k] * y2[k+1] + u[k]
-
-            # 查询插值
-            xq = np.asarray(xq, dtype=np.float64)
-            out = np.zeros_like(xq, dtype=np.float64)
-            for idx, xval in enumerate(xq):
-                # 边界处理
-                if xval <= xs[0]:
-                    out[idx] = ys[0]
-                    continue
-                if xval >= xs[-1]:
-                    out[idx] = ys[-1]
-                    continue
-                # 找到间隔 klo,khi
-                klo = np.searchsorted(xs, xval) - 1
-                khi = klo + 1
-                h = xs[khi] - xs[klo]
-                if h == 0:
-                    out[idx] = ys[klo]
-                    continue
-                a = (xs[khi] - xval) / h
-                b = (xval - xs[klo]) / h
-                out[idx] = a * ys[klo] + b * ys[khi] + ((a**3 - a) * y2[klo] + (b**3 - b) * y2[khi]) * (h*h) / 6.0
-            return out
-
-        # 若 points_str 为 JSON，则按 Photoshop 逻辑组合：先单通道（R/G/B）再应用 RGB 复合曲线
-        try:
-            if isinstance(points_str, str) and points_str.strip().startswith('{'):
-                data = json.loads(points_str)
-                # 准备每通道的 LUT（优先使用提供的通道点，否则使用单位映射）
-                def make_lut_from_str(s):
-                    if not s:
-                        return np.arange(256, dtype=np.uint8)
-                    xs, ys = parse_points_list(s)
-                    interp_y = natural_cubic_spline_interpolate(xs, ys, np.arange(256, dtype=np.float64))
-                    return np.clip(np.round(interp_y), 0, 255).astype(np.uint8)
-
-                lut_r_chan = make_lut_from_str(data.get('R', ''))
-                lut_g_chan = make_lut_from_str(data.get('G', ''))
-                lut_b_chan = make_lut_from_str(data.get('B', ''))
-                lut_rgb = make_lut_from_str(data.get('RGB', ''))
-
-                # 先应用通道 LUT，再应用 RGB 复合 LUT
-                final_r = lut_rgb[lut_r_chan]
-                final_g = lut_rgb[lut_g_chan]
-                final_b = lut_rgb[lut_b_chan]
-                return final_r, final_g, final_b
-        except Exception:
-            # 如果 JSON 解析失败，回退到原有单通道解析逻辑
-            pass
-
-        def natural_cubic_spline_interpolate(xs, ys, xq):
-            """
-            基于 Numerical Recipes 的自然三次样条实现。
-            xs, ys: 已排序的节点，xq: 查询点数组
-            返回对应的插值结果（float array）
-            """
-            n = len(xs)
-            if n < 2:
-                return np.zeros_like(xq, dtype=np.float64)
-
-            # 计算二阶导数 y2
-            y2 = np.zeros(n, dtype=np.float64)
-            u = np.zeros(n-1, dtype=np.float64)
-            y2[0] = 0.0
-            u[0] = 0.0
-            for i in range(1, n-1):
-                sig = (xs[i] - xs[i-1]) / (xs[i+1] - xs[i-1])
-                p = sig * y2[i-1] + 2.0
-                if p == 0:
-                    y2[i] = 0.0
-                    u[i] = 0.0
-                else:
-                    y2[i] = (sig - 1.0) / p
-                    denom = (xs[i+1] - xs[i-1])
-                    if denom == 0:
-                        u[i] = 0.0
-                    else:
-                        u[i] = (6.0 * ((ys[i+1]-ys[i])/(xs[i+1]-xs[i]) - (ys[i]-ys[i-1])/(xs[i]-xs[i-1])) / denom - sig * u[i-1]) / p
-            y2[-1] = 0.0
-            for k in range(n-2, -1, -1):
-                y2[k] = y2[k] * y2[k+1] + u[k]
-
-            # 查询插值
-            xq = np.asarray(xq, dtype=np.float64)
-            out = np.zeros_like(xq, dtype=np.float64)
-            for idx, xval in enumerate(xq):
-                # 边界处理
-                if xval <= xs[0]:
-                    out[idx] = ys[0]
-                    continue
-                if xval >= xs[-1]:
-                    out[idx] = ys[-1]
-                    continue
-                # 找到间隔 klo,khi
-                klo = np.searchsorted(xs, xval) - 1
-                khi = klo + 1
-                h = xs[khi] - xs[klo]
-                if h == 0:
-                    out[idx] = ys[klo]
-                    continue
-                a = (xs[khi] - xval) / h
-                b = (xval - xs[klo]) / h
-                out[idx] = a * ys[klo] + b * ys[khi] + ((a**3 - a) * y2[klo] + (b**3 - b) * y2[khi]) * (h*h) / 6.0
-            return out
+        return _compile_curve_luts(normalize_curve_points(points_str), channel, lut_size)
 
-        full_x = np.arange(256, dtype=np.float64)
-        interp_y = natural_cubic_spline_interpolate(xs, ys, full_x)
-        interp_y = np.clip(np.round(interp_y), 0, 255).astype(np.uint8)
-
-        if channel == "RGB":
-            return interp_y, interp_y, interp_y
-        elif channel == "R":
-            return interp_y, np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8)
-        elif channel == "G":
-            return np.arange(256, dtype=np.uint8), interp_y, np.arange(256, dtype=np.uint8)
-        else:  # "B"
-            return np.arange(256, dtype=np.uint8), np.arange(256, dtype=np.uint8), interp_y
-
-    def apply_luts(self, pil_image, lut_r, lut_g, lut_b):
+    def apply_luts(self, images, lut_r, lut_g, lut_b):
         """
-        使用PIL的point映射应用三通道查找表
+        在 IMAGE 批次 [B, H, W, C] 上直接应用三通道查找表（torch 索引，一次处理所有帧）
         """
-        if pil_image.mode != "RGB":
-            img = pil_image.convert("RGB")
-        else:
-            img = pil_image
-
-        # 分离通道
-        r, g, b = img.split()
-
-        r = r.point(list(lut_r))
-        g = g.point(list(lut_g))
-        b = b.point(list(lut_b))
-
-        return Image.merge("RGB", (r, g, b))
-
-    def tensor_to_pil(self, tensor):
-        """将tensor转换为PIL图像（复用之前实现风格）"""
-        if len(tensor.shape) == 3:
-            if tensor.shape[0] == 3 or tensor.shape[0] == 1:
-                tensor = tensor.permute(1, 2, 0)
-
-        tensor = torch.clamp(tensor, 0, 1)
-        numpy_image = tensor.cpu().numpy()
-        numpy_image = (numpy_image * 255).astype(np.uint8)
-
-        if len(numpy_image.shape) == 2:
-            pil_image = Image.fromarray(numpy_image, mode='L').convert('RGB')
-        elif numpy_image.shape[2] == 1:
-            pil_image = Image.fromarray(numpy_image.squeeze(), mode='L').convert('RGB')
-        else:
-            pil_image = Image.fromarray(numpy_image, mode='RGB')
-
-        return pil_image
-
-    def pil_to_tensor(self, pil_image):
-        """将PIL图像转换为tensor（与其他节点一致的输出格式）"""
-        if pil_image.mode != 'RGB':
-            pil_image = pil_image.convert('RGB')
-
-        numpy_image = np.array(pil_image).astype(np.float32)
-        numpy_image = numpy_image / 255.0
-        tensor = torch.from_numpy(numpy_image)
-        tensor = tensor.unsqueeze(0)
-        return tensor
+        return apply_luts_tensor(images, lut_r, lut_g, lut_b)
+
+
+
+# 曲线编译结果缓存的容量（每项为三张查找表）
+CURVE_CACHE_SIZE = 256
+
+
+def normalize_curve_points(points_str):
+    """
+    将曲线参数规范化为缓存键：JSON 按键排序重新序列化，点串去除空白
+    语义相同但书写不同的参数得到同一个键
+    """
+    if not isinstance(points_str, str):
+        return str(points_str)
+    text = points_str.strip()
+    if text.startswith('{'):
+        try:
+            return json.dumps(json.loads(text), sort_keys=True, separators=(',', ':'))
+        except Exception:
+            return text
+    return ''.join(text.split())
+
+
+def curve_cache_info():
+    """曲线编译缓存的命中统计（hits/misses/maxsize/currsize），用于监控"""
+    return _compile_curve_luts.cache_info()
+
+
+def _parse_points_list(s):
+    """解析 "x0,y0;x1,y1;..." 点串，返回按 x 排序去重的节点数组"""
+    pts = []
+    try:
+        for part in s.split(';'):
+            ss = part.strip()
+            if not ss:
+                continue
+            x_str, y_str = ss.split(',')
+            x = int(float(x_str))
+            y = int(float(y_str))
+            x = max(0, min(255, x))
+            y = max(0, min(255, y))
+            pts.append((x, y))
+    except Exception:
+        pts = [(0, 0), (255, 255)]
+    if not pts:
+        pts = [(0, 0), (255, 255)]
+    if pts[0][0] != 0:
+        pts.insert(0, (0, 0))
+    if pts[-1][0] != 255:
+        pts.append((255, 255))
+    xs = np.array([p[0] for p in pts], dtype=np.float64)
+    ys = np.array([p[1] for p in pts], dtype=np.float64)
+    # 样条要求节点严格递增：排序并去掉重复的 x（保留先出现的点）
+    xs, first = np.unique(xs, return_index=True)
+    return xs, ys[first]
+
+
+def _natural_cubic_spline(xs, ys, xq):
+    """
+    向量化的自然三次样条（比线性更接近 Photoshop 曲线）
+    先解三对角方程组得到各节点二阶导数，再对全部查询点一次性求值
+    xs: 严格递增的节点，ys: 节点值，xq: 查询点数组
+    """
+    xq = np.asarray(xq, dtype=np.float64)
+    n = len(xs)
+    if n < 2:
+        return np.zeros_like(xq, dtype=np.float64)
+
+    h = np.diff(xs)
+    slopes = np.diff(ys) / h
+
+    # 自然边界：两端二阶导数为 0，只需求解内部 n-2 个未知量
+    m = np.zeros(n, dtype=np.float64)
+    if n > 2:
+        system = np.diag(2.0 * (h[:-1] + h[1:]))
+        system += np.diag(h[1:-1], 1) + np.diag(h[1:-1], -1)
+        m[1:-1] = np.linalg.solve(system, 6.0 * np.diff(slopes))
+
+    # 每个查询点所在区间 [k, k+1]
+    k = np.clip(np.searchsorted(xs, xq) - 1, 0, n - 2)
+    hk = h[k]
+    a = (xs[k + 1] - xq) / hk
+    b = (xq - xs[k]) / hk
+    out = a * ys[k] + b * ys[k + 1] + ((a ** 3 - a) * m[k] + (b ** 3 - b) * m[k + 1]) * (hk * hk) / 6.0
+
+    # 边界外取端点值
+    out[xq <= xs[0]] = ys[0]
+    out[xq >= xs[-1]] = ys[-1]
+    return out
+
+
+@functools.lru_cache(maxsize=CURVE_CACHE_SIZE)
+def _compile_curve_luts(points_key, channel, lut_size):
+    """
+    将（规范化后的）曲线参数编译为三通道查找表，结果被缓存，返回只读数组
+    支持两种格式：
+    1) 传统单通道字符串 "x0,y0;x1,y1;..."
+    2) JSON 字符串 {"RGB":"...","R":"...","G":"...","B":"..."} 表示每个通道的点串
+    """
+    # 查询点及结果格式：8 位模式取 0-255 整数并量化，浮点模式在 0-255 上均匀采样并归一化
+    if lut_size is None:
+        full_x = np.arange(256, dtype=np.float64)
+    else:
+        full_x = np.linspace(0.0, 255.0, lut_size)
+
+    def finish_lut(interp_y):
+        if lut_size is None:
+            return np.clip(np.round(interp_y), 0, 255).astype(np.uint8)
+        return np.clip(interp_y / 255.0, 0.0, 1.0).astype(np.float32)
+
+    def freeze(*luts):
+        for lut in luts:
+            lut.flags.writeable = False
+        return luts
+
+    identity = finish_lut(full_x)
+
+    # 若为 JSON，则按 Photoshop 逻辑组合：先单通道（R/G/B）再应用 RGB 复合曲线
+    if points_key.startswith('{'):
+        try:
+            data = json.loads(points_key)
+        except Exception:
+            # 如果 JSON 解析失败，回退到单通道解析逻辑
+            data = None
+        if isinstance(data, dict):
+            # 准备每通道的 LUT（优先使用提供的通道点，否则使用单位映射）
+            def make_lut_from_str(s):
+                if not s:
+                    return identity
+                xs, ys = _parse_points_list(s)
+                return finish_lut(_natural_cubic_spline(xs, ys, full_x))
+
+            lut_r_chan = make_lut_from_str(data.get('R', ''))
+            lut_g_chan = make_lut_from_str(data.get('G', ''))
+            lut_b_chan = make_lut_from_str(data.get('B', ''))
+            lut_rgb = make_lut_from_str(data.get('RGB', ''))
+
+            # 先应用通道 LUT，再应用 RGB 复合 LUT
+            if lut_size is None:
+                return freeze(lut_rgb[lut_r_chan], lut_rgb[lut_g_chan], lut_rgb[lut_b_chan])
+            final_r = np.interp(lut_r_chan, identity, lut_rgb).astype(np.float32)
+            final_g = np.interp(lut_g_chan, identity, lut_rgb).astype(np.float32)
+            final_b = np.interp(lut_b_chan, identity, lut_rgb).astype(np.float32)
+            return freeze(final_r, final_g, final_b)
+
+    xs, ys = _parse_points_list(points_key)
+    interp_y = finish_lut(_natural_cubic_spline(xs, ys, full_x))
+
+    if channel == "RGB":
+        return freeze(interp_y, interp_y, interp_y)
+    elif channel == "R":
+        return freeze(interp_y, identity, identity)
+    elif channel == "G":
+        return freeze(identity, interp_y, identity)
+    else:  # "B"
+        return freeze(identity, identity, interp_y)
 
 
 # 节点映射
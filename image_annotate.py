@@ -1,7 +1,8 @@
 import torch
-import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import os
+from .image_utils import pil_to_tensor, as_batch, rgb_channels
+from .result_cache import cached_result, inputs_fingerprint
 
 class ImageAnnotateWithPanel:
     """
@@ -83,16 +84,16 @@ class ImageAnnotateWithPanel:
     FUNCTION = "annotate_image"
     CATEGORY = "🔵BB image crop"
     
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        """控件值的指纹（ComfyUI 调用时只传入控件值，不含连线输入；连线输入是否变化由 ComfyUI 按上游节点判断）"""
+        return inputs_fingerprint(kwargs)
+    
+    @cached_result
     def annotate_image(self, image, marker_size, font_mode, font_scale, font_size_px, font_weight, font_family, marker_color, text_color, label_type, separator, label_prefix, text_format, annotations, selected_index=-1):
         """
         图像标注主函数
         """
-        # 转换tensor到PIL图像
-        if len(image.shape) == 4:
-            pil_image = self.tensor_to_pil(image[0])
-        else:
-            pil_image = self.tensor_to_pil(image)
-        
         # 解析标注数据
         annotation_points = self.parse_annotations(annotations)
         
@@ -105,19 +106,21 @@ class ImageAnnotateWithPanel:
         # 获取10个独立标签
         individual_labels = self.get_individual_labels(annotation_points, label_type, label_prefix, text_format)
         
+        batch = rgb_channels(as_batch(image)).clamp(0, 1)
+        
         # 如果没有标注点，返回原图
         if not annotation_points:
-            return (self.pil_to_tensor(pil_image), labels_text, selected_label, *individual_labels)
+            return (batch, labels_text, selected_label, *individual_labels)
         
-        # 创建标注图像
-        annotated_image = self.draw_annotations(
-            pil_image, annotation_points, 
+        # 创建标注图层（所有帧共用同一个图层）
+        overlay = self.render_overlay(
+            (batch.shape[2], batch.shape[1]), annotation_points, 
             marker_size, marker_color, text_color,
             font_mode, font_scale, font_size_px, font_weight, font_family
         )
         
-        # 转换回tensor
-        result_tensor = self.pil_to_tensor(annotated_image)
+        # 一次性叠加到整个批次
+        result_tensor = self.composite_overlay(batch, overlay)
         
         return (result_tensor, labels_text, selected_label, *individual_labels)
     
@@ -230,18 +233,20 @@ class ImageAnnotateWithPanel:
         
         return result_labels
     
-    def draw_annotations(self, image, points, marker_size, marker_color, text_color, font_mode, font_scale, font_size_px, font_weight, font_family):
+    def composite_overlay(self, images, overlay):
         """
-        在图像上绘制标注
+        将 RGBA 标注图层一次性叠加到整个批次 [B, H, W, 3] 上
+        """
+        overlay_tensor = pil_to_tensor(overlay).to(images.device)
+        alpha = overlay_tensor[..., 3:]
+        return torch.lerp(images, overlay_tensor[..., :3], alpha)
+    
+    def render_overlay(self, size, points, marker_size, marker_color, text_color, font_mode, font_scale, font_size_px, font_weight, font_family):
+        """
+        在透明图层上绘制所有标注，返回 RGBA 图层
         """
-        # 转换为RGBA以支持更好的绘制效果
-        if image.mode != 'RGBA':
-            result_image = image.convert('RGBA')
-        else:
-            result_image = image.copy()
-        
         # 创建绘图层
-        overlay = Image.new('RGBA', result_image.size, (0, 0, 0, 0))
+        overlay = Image.new('RGBA', size, (0, 0, 0, 0))
         draw = ImageDraw.Draw(overlay)
         
         # 颜色映射
@@ -319,13 +324,7 @@ class ImageAnnotateWithPanel:
             # 绘制标记点（类似地图标记的形状）
             self.draw_map_marker(draw, x, y, marker_size, marker_fill, label, text_fill, font)
         
-        # 合并图层
-        result_image = Image.alpha_composite(result_image, overlay)
-        
-        # 转换回RGB
-        result_image = result_image.convert('RGB')
-        
-        return result_image
+        return overlay
     
     def draw_map_marker(self, draw, x, y, size, fill_color, label, text_color, font):
         """
@@ -375,40 +374,6 @@ class ImageAnnotateWithPanel:
         except:
             # 如果textbbox不可用，使用旧方法
             draw.text((x - size // 4, y - size // 4), label, fill=text_color, font=font)
-    
-    def tensor_to_pil(self, tensor):
-        """将tensor转换为PIL图像"""
-        if len(tensor.shape) == 3:
-            if tensor.shape[0] == 3 or tensor.shape[0] == 1:
-                tensor = tensor.permute(1, 2, 0)
-        
-        tensor = torch.clamp(tensor, 0, 1)
-        numpy_image = tensor.cpu().numpy()
-        numpy_image = (numpy_image * 255).astype(np.uint8)
-        
-        if len(numpy_image.shape) == 2:
-            pil_image = Image.fromarray(numpy_image, mode='L').convert('RGB')
-        elif numpy_image.shape[2] == 1:
-            pil_image = Image.fromarray(numpy_image.squeeze(), mode='L').convert('RGB')
-        else:
-            pil_image = Image.fromarray(numpy_image, mode='RGB')
-        
-        return pil_image
-    
-    def pil_to_tensor(self, pil_image):
-        """将PIL图像转换为tensor"""
-        if pil_image.mode == 'RGBA':
-            pil_image = pil_image.convert('RGB')
-        elif pil_image.mode != 'RGB':
-            pil_image = pil_image.convert('RGB')
-        
-        numpy_image = np.array(pil_image).astype(np.float32)
-        numpy_image = numpy_image / 255.0
-        tensor = torch.from_numpy(numpy_image)
-        tensor = tensor.unsqueeze(0)
-        
-        return tensor
-
 
 NODE_CLASS_MAPPINGS = {
     "ImageAnnotateWithPanel": ImageAnnotateWithPanel,
@@ -0,0 +1,256 @@
+import hashlib
+import warnings
+import threading
+import contextlib
+import weakref
+import torch
+import torch.nn.functional as F
+import numpy as np
+from PIL import Image
+
+
+# 浮点 -> uint8 转换时每次处理的元素数量（复用同一块临时缓冲区）
+_CONVERT_CHUNK = 1 << 22
+
+
+def tensor_to_uint8(tensor, out=None):
+    """
+    将 IMAGE tensor 转换为 uint8 numpy 数组 [..., H, W, C]
+    - uint8 输入直接返回视图（零拷贝）
+    - 浮点输入分块在一块复用的临时缓冲区内原地缩放/clamp，不生成整帧浮点副本
+    - out: 可选的预分配 uint8 tensor，形状需与输入一致
+    """
+    if tensor.device.type != "cpu":
+        tensor = tensor.cpu()
+
+    if tensor.dtype == torch.uint8:
+        if out is None:
+            return tensor.numpy()
+        out.copy_(tensor)
+        return out.numpy()
+
+    if out is None:
+        out = torch.empty(tensor.shape, dtype=torch.uint8)
+
+    flat_in = tensor.contiguous().view(-1)
+    flat_out = out.view(-1)
+    total = flat_in.numel()
+    scratch = torch.empty(min(total, _CONVERT_CHUNK), dtype=tensor.dtype)
+    for start in range(0, total, _CONVERT_CHUNK):
+        end = min(total, start + _CONVERT_CHUNK)
+        buf = scratch[:end - start]
+        # 与原实现一致：clamp(0,1) * 255 后截断为 uint8
+        torch.mul(flat_in[start:end], 255.0, out=buf)
+        buf.clamp_(0, 255)
+        flat_out[start:end].copy_(buf)
+    return out.numpy()
+
+
+def uint8_to_tensor(array, out=None):
+    """
+    将 uint8 数组 [..., H, W, C] 转换为 0-1 的 float32 tensor
+    out: 可选的预分配 float32 tensor，直接写入避免中间拷贝
+    """
+    array = np.ascontiguousarray(array)
+    with warnings.catch_warnings():
+        # PIL 缓冲区是只读的；这里只读取，不会写入源数组
+        warnings.simplefilter("ignore", UserWarning)
+        src = torch.from_numpy(array)
+    if out is None:
+        out = torch.empty(src.shape, dtype=torch.float32)
+    out.copy_(src)
+    out.div_(255.0)
+    return out
+
+
+def tensor_to_pil(tensor):
+    """将tensor [H, W, C]（或 [C, H, W]）转换为PIL图像"""
+    if len(tensor.shape) == 3:
+        if tensor.shape[0] == 3 or tensor.shape[0] == 1:  # [C, H, W]
+            tensor = tensor.permute(1, 2, 0)
+
+    numpy_image = tensor_to_uint8(tensor)
+
+    if len(numpy_image.shape) == 2:
+        # 灰度图像
+        return Image.fromarray(numpy_image).convert('RGB')
+    if numpy_image.shape[2] == 1:
+        # 单通道图像
+        return Image.fromarray(numpy_image[:, :, 0]).convert('RGB')
+    if numpy_image.shape[2] == 4:
+        return Image.fromarray(numpy_image)
+    return Image.fromarray(numpy_image)
+
+
+def pil_to_tensor(pil_image, out=None):
+    """
+    将PIL图像转换为tensor [1, H, W, C]
+    RGBA 保留 alpha 通道，其余模式统一转换为 RGB
+    """
+    if pil_image.mode not in ('RGB', 'RGBA'):
+        pil_image = pil_image.convert('RGB')
+
+    # np.asarray 直接引用 PIL 缓冲区，只在写入 float32 时分配一次
+    tensor = uint8_to_tensor(np.asarray(pil_image), out=out)
+    return tensor.unsqueeze(0)
+
+
+def as_batch(image):
+    """IMAGE 输入统一为 [B, H, W, C]（兼容单帧 [H, W, C]）"""
+    if len(image.shape) == 3:
+        return image.unsqueeze(0)
+    return image
+
+
+def pil_list_to_tensor(pil_images):
+    """
+    将多帧尺寸一致的PIL图像写入一个预分配的 [B, H, W, C] tensor
+    各帧统一为第一帧的模式（RGB 或 RGBA）
+    """
+    mode = 'RGBA' if pil_images[0].mode == 'RGBA' else 'RGB'
+    width, height = pil_images[0].size
+    channels = len(mode)
+
+    out = torch.empty((len(pil_images), height, width, channels), dtype=torch.float32)
+    for i, pil_image in enumerate(pil_images):
+        if pil_image.mode != mode:
+            pil_image = pil_image.convert(mode)
+        uint8_to_tensor(np.asarray(pil_image), out=out[i])
+    return out
+
+
+def rgb_channels(images):
+    """取 [..., C] 的 RGB 三通道：单通道扩展为三通道，RGBA 丢弃 alpha"""
+    channels = images.shape[-1]
+    if channels == 1:
+        return images.expand(*images.shape[:-1], 3)
+    if channels > 3:
+        return images[..., :3]
+    return images
+
+
+def gray_proxy(frame, max_size):
+    """单帧 [H, W, C] -> 长边不超过 max_size 的灰度图 [1, 1, h, w]（float32，面积平均缩小）"""
+    if frame.device.type != "cpu":
+        frame = frame.cpu()
+    if frame.dtype != torch.float32:
+        frame = frame.float() / 255.0 if frame.dtype == torch.uint8 else frame.float()
+    height, width = frame.shape[0], frame.shape[1]
+    gray = (rgb_channels(frame) @ torch.tensor([0.299, 0.587, 0.114], dtype=torch.float32))[None, None]
+
+    scale = max_size / max(height, width)
+    if scale < 1.0:
+        size = (max(1, round(height * scale)), max(1, round(width * scale)))
+        gray = F.interpolate(gray, size=size, mode="area")
+    return gray
+
+
+# 内容指纹的采样元素数量
+_FINGERPRINT_SAMPLES = 1 << 16
+
+# 已计算指纹的 tensor（按对象 id 与指纹类型，弱引用 + 版本号校验），上游输出被重复使用时不必重新遍历
+_FINGERPRINT_MEMO_SIZE = 64
+_fingerprint_memo = {}
+
+# 当前线程正在执行的节点内的指纹记录（见 fingerprint_scope），inference_mode 下的 tensor 只在其中复用
+_scope_state = threading.local()
+
+
+@contextlib.contextmanager
+def fingerprint_scope():
+    """
+    一次节点执行内复用指纹：inference_mode 下的 tensor 没有版本号，无法跨执行复用，
+    但同一次执行内输入不会被原地修改，结果缓存键、源图缓存、预览代理等各处只需计算一次
+    可嵌套，只有最外层退出时清空
+    """
+    outer = getattr(_scope_state, "memo", None)
+    if outer is None:
+        _scope_state.memo = {}
+    try:
+        yield
+    finally:
+        if outer is None:
+            _scope_state.memo = None
+
+
+def _memo_get(tensor, kind):
+    if tensor.is_inference():
+        memo = getattr(_scope_state, "memo", None)
+        entry = memo.get((id(tensor), kind)) if memo is not None else None
+        return entry[1] if entry is not None and entry[0]() is tensor else None
+    entry = _fingerprint_memo.get((id(tensor), kind))
+    if entry is not None and entry[0]() is tensor and entry[1] == tensor._version:
+        return entry[2]
+    return None
+
+
+def _memo_put(tensor, kind, value):
+    if tensor.is_inference():
+        memo = getattr(_scope_state, "memo", None)
+        if memo is not None:
+            memo[(id(tensor), kind)] = (weakref.ref(tensor), value)
+        return
+    if len(_fingerprint_memo) >= _FINGERPRINT_MEMO_SIZE:
+        for key in [k for k, v in _fingerprint_memo.items() if v[0]() is None]:
+            del _fingerprint_memo[key]
+        while len(_fingerprint_memo) >= _FINGERPRINT_MEMO_SIZE:
+            del _fingerprint_memo[next(iter(_fingerprint_memo))]
+    _fingerprint_memo[(id(tensor), kind)] = (weakref.ref(tensor), tensor._version, value)
+
+
+def tensor_content_hash(tensor):
+    """
+    完整内容哈希：形状/类型 + 全部元素字节的 blake2b
+    用于结果缓存、源图缓存等误命中会输出错误结果的场合
+    同一个 tensor 对象在未被原地修改（_version 未变）时直接返回上次的哈希；
+    inference_mode 下创建的 tensor 没有版本号，只在同一次 fingerprint_scope 内复用
+    """
+    content_hash = _memo_get(tensor, "content")
+    if content_hash is None:
+        content_hash = _compute_content_hash(tensor)
+        _memo_put(tensor, "content", content_hash)
+    return content_hash
+
+
+def tensor_fingerprint(tensor):
+    """
+    快速内容指纹：形状/类型 + 等间隔采样的元素值 + 逐行求和
+    不是完整哈希（例如同一行内交换两个值不会改变指纹），只用于误命中无害的场合（如预览代理图）
+    已算过完整内容哈希的 tensor 直接返回该哈希
+    """
+    fingerprint = _memo_get(tensor, "content") or _memo_get(tensor, "sampled")
+    if fingerprint is None:
+        fingerprint = _compute_fingerprint(tensor)
+        _memo_put(tensor, "sampled", fingerprint)
+    return fingerprint
+
+
+def _compute_content_hash(tensor):
+    tensor = tensor.detach()
+    if tensor.device.type != "cpu":
+        tensor = tensor.cpu()
+    if not tensor.is_contiguous():
+        tensor = tensor.contiguous()
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((tuple(tensor.shape), str(tensor.dtype))).encode())
+    if tensor.numel() > 0:
+        # 按字节视图直接哈希，不复制整块数据
+        digest.update(memoryview(tensor.view(-1).view(torch.uint8).numpy()))
+    return digest.hexdigest()
+
+
+def _compute_fingerprint(tensor):
+    tensor = tensor.detach()
+    if not tensor.is_contiguous():
+        tensor = tensor.contiguous()
+    flat = tensor.view(-1)
+    step = max(1, flat.numel() // _FINGERPRINT_SAMPLES)
+    sample = flat[::step][:_FINGERPRINT_SAMPLES].cpu().contiguous()
+
+    digest = hashlib.blake2b(digest_size=16)
+    digest.update(repr((tuple(tensor.shape), str(tensor.dtype), flat.numel())).encode())
+    digest.update(sample.numpy().tobytes())
+    if tensor.dim() >= 2 and flat.numel() > 0:
+        row_sums = tensor.reshape(-1, tensor.shape[-2] * tensor.shape[-1]).sum(dim=1, dtype=torch.float32)
+        digest.update(row_sums.cpu().numpy().tobytes())
+    return digest.hexdigest()
@@ -1,6 +1,17 @@
-import torch
-import numpy as np
+import os
+import math
 from PIL import Image, ImageDraw
+from .image_utils import tensor_to_pil, pil_to_tensor, as_batch, pil_list_to_tensor, tensor_content_hash
+from .preview_utils import PREVIEW_MAX_SIZE, preview_canvas, shade_outside
+from .result_cache import ResultCache, cached_result, inputs_fingerprint
+from .parallel_utils import parallel_map, tiled_reduce
+
+# 源帧缓存的容量上限（MB，环境变量 BB_SOURCE_CACHE_MB，0 表示关闭）
+# 按输入内容 + 预滤波倍数缓存整个批次的 PIL 图像；超过上限的批次（长视频等）不缓存
+SOURCE_CACHE_MB = int(os.environ.get("BB_SOURCE_CACHE_MB", 256))
+
+_source_cache = ResultCache(SOURCE_CACHE_MB * 1024 * 1024)
+
 
 class InteractiveCropWithPanel:
     """
@@ -60,48 +71,104 @@ class InteractiveCropWithPanel:
     FUNCTION = "crop_image"
     CATEGORY = "🔵BB image crop"
     
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        """控件值的指纹（ComfyUI 调用时只传入控件值，不含连线输入；连线输入是否变化由 ComfyUI 按上游节点判断）"""
+        return inputs_fingerprint(kwargs)
+    
+    @cached_result(disk=True)
     def crop_image(self, image, crop_width, crop_height, offset_x=0, offset_y=0, scale=1.0, rotation=0.0):
         """
         执行图像剪裁并生成预览
         面板版本：offset、scale和rotation由面板交互控制
         """
-        # 转换tensor到PIL图像
-        if len(image.shape) == 4:
-            pil_image = self.tensor_to_pil(image[0])
-        else:
-            pil_image = self.tensor_to_pil(image)
-        
-        original_width, original_height = pil_image.size
-        
-        # 应用旋转
-        if rotation != 0.0:
-            pil_image = pil_image.rotate(-rotation, expand=True, resample=Image.Resampling.BICUBIC, fillcolor=(0, 0, 0))
-        
-        # 应用缩放
-        if scale != 1.0:
-            new_width = int(pil_image.width * scale)
-            new_height = int(pil_image.height * scale)
-            pil_image = pil_image.resize((new_width, new_height), Image.Resampling.LANCZOS)
-        
-        # 计算剪裁区域
-        img_width, img_height = pil_image.size
-        
-        # 计算剪裁起始位置（居中 + 偏移）
-        start_x = (img_width - crop_width) // 2 + offset_x
-        start_y = (img_height - crop_height) // 2 + offset_y
-        
-        # 执行剪裁
-        cropped_image = self.perform_crop(pil_image, start_x, start_y, crop_width, crop_height)
-        
-        # 生成预览图像（显示剪裁区域）
-        preview_image = self.create_preview(pil_image, start_x, start_y, crop_width, crop_height)
-        
+        batch = as_batch(image)
+        source_size = (batch.shape[2], batch.shape[1])
+        matrix = self.crop_matrix(source_size, crop_width, crop_height, offset_x, offset_y, scale, rotation)
+        factor = prefilter_factor(matrix)
+
+        # 源帧（转换为 PIL 并按预滤波倍数缩小）按输入内容缓存：拖动剪裁框只改变偏移，
+        # 不再重复转换整张图，每次只采样剪裁窗口
+        frames = self.source_frames(batch, factor)
+
+        # 逐帧处理整个批次，所有帧使用相同的剪裁参数
+        cropped_frames = parallel_map(
+            lambda frame: self.crop_region(frame, matrix, crop_width, crop_height, factor), frames)
+
         # 转换回tensor
-        cropped_tensor = self.pil_to_tensor(cropped_image)
-        preview_tensor = self.pil_to_tensor(preview_image)
-        
+        cropped_tensor = pil_list_to_tensor(cropped_frames)
+
+        # 生成预览图像（在缩小的画布上显示第一帧的剪裁区域）
+        preview_image = self.render_preview(batch, crop_width, crop_height, offset_x, offset_y, scale, rotation)
+        preview_tensor = pil_to_tensor(preview_image)
+
         return (cropped_tensor, preview_tensor)
-    
+
+    def crop_matrix(self, source_size, crop_width, crop_height, offset_x, offset_y, scale, rotation):
+        """
+        剪裁窗口的逆向仿射矩阵：输出坐标 -> 缩放后坐标 -> 旋转后坐标 -> 原图坐标
+        先旋转（画布扩展）、再缩放、最后从缩放后画布的中心按偏移量剪裁
+        """
+        matrix, (scaled_width, scaled_height) = transform_matrix(source_size, scale, rotation)
+        start_x = (scaled_width - crop_width) // 2 + offset_x
+        start_y = (scaled_height - crop_height) // 2 + offset_y
+        return compose_affine(matrix, 1.0, 1.0, start_x, start_y)
+
+    def source_frames(self, images, factor):
+        """
+        返回批次中每帧的 RGB PIL 图像（factor > 1 时已按整数倍盒式缩小）
+        按 (输入内容指纹, factor) 缓存，参数变化时无需重新转换/缩小整张图
+        """
+        key = (tensor_content_hash(images), factor)
+        frames = _source_cache.get(key)
+        if frames is not None:
+            return frames
+
+        def prepare(frame):
+            pil_image = tensor_to_pil(frame)
+            if pil_image.mode != 'RGB':
+                pil_image = pil_image.convert('RGB')
+            return tiled_reduce(pil_image, factor)
+
+        # 多帧时各帧并行；单帧大图时 reduce 按行分块并行
+        frames = parallel_map(prepare, images)
+
+        _source_cache.put(key, frames)
+        return frames
+
+    def crop_region(self, pil_image, matrix, crop_width, crop_height, factor=1):
+        """
+        按 crop_matrix 从源帧采样剪裁窗口，计算量只与剪裁尺寸相关
+        pil_image 已按 factor 缩小时矩阵同步换算到缩小后的坐标
+        """
+        a, b, c, d, e, f = matrix
+        # 无旋转、无缩放时就是整数偏移的剪裁，直接复制像素
+        if (a, b, d, e) == (1.0, 0.0, 0.0, 1.0) and float(c).is_integer() and float(f).is_integer():
+            return self.perform_crop(pil_image, int(c), int(f), crop_width, crop_height)
+
+        if factor > 1:
+            matrix = [v / factor for v in matrix]
+        return pil_image.transform((crop_width, crop_height), Image.Transform.AFFINE, matrix,
+                                   resample=Image.Resampling.BICUBIC, fillcolor=(0, 0, 0))
+
+    def render_preview(self, images, crop_width, crop_height, offset_x, offset_y, scale, rotation):
+        """
+        预览：把缓存的代理图按同样的旋转/缩放采样到 PREVIEW_MAX_SIZE 以内的画布，
+        剪裁框按相同比例绘制，开销与原图分辨率无关
+        """
+        proxy, proxy_factor = preview_canvas(images)
+        matrix, (scaled_width, scaled_height) = transform_matrix((images.shape[2], images.shape[1]), scale, rotation)
+        zoom = min(1.0, PREVIEW_MAX_SIZE / max(scaled_width, scaled_height))
+        preview_size = (max(1, round(scaled_width * zoom)), max(1, round(scaled_height * zoom)))
+
+        # 预览坐标 -> 缩放后坐标 -> 原图坐标 -> 代理图坐标
+        matrix = [v * proxy_factor for v in compose_affine(matrix, 1.0 / zoom, 1.0 / zoom)]
+        preview = affine_sample(proxy, matrix, preview_size)
+
+        start_x = (scaled_width - crop_width) // 2 + offset_x
+        start_y = (scaled_height - crop_height) // 2 + offset_y
+        return self.create_preview(preview, start_x * zoom, start_y * zoom, crop_width * zoom, crop_height * zoom)
+
     def perform_crop(self, image, start_x, start_y, crop_width, crop_height):
         """执行实际的剪裁操作"""
         img_width, img_height = image.size
@@ -174,67 +241,78 @@ class InteractiveCropWithPanel:
                   fill=(0, 255, 0), width=3)
         
         # 半透明遮罩（剪裁区域外）
-        mask = Image.new('RGBA', preview.size, (0, 0, 0, 120))
-        mask_draw = ImageDraw.Draw(mask)
-        
-        # 清除剪裁区域的遮罩
-        mask_draw.rectangle([start_x, start_y, end_x, end_y], fill=(0, 0, 0, 0))
-        
-        # 应用遮罩
-        preview = preview.convert('RGBA')
-        preview = Image.alpha_composite(preview, mask)
-        preview = preview.convert('RGB')
+        preview = shade_outside(preview, (start_x, start_y, end_x, end_y))
         
         return preview
-    
-    def tensor_to_pil(self, tensor):
-        """将tensor转换为PIL图像"""
-        # tensor shape: [H, W, C] 或 [C, H, W]
-        if len(tensor.shape) == 3:
-            if tensor.shape[0] == 3 or tensor.shape[0] == 1:  # [C, H, W]
-                tensor = tensor.permute(1, 2, 0)  # 转换为 [H, W, C]
-        
-        # 确保值在0-1范围内
-        tensor = torch.clamp(tensor, 0, 1)
-        
-        # 转换为numpy数组
-        numpy_image = tensor.cpu().numpy()
-        
-        # 转换为0-255范围
-        numpy_image = (numpy_image * 255).astype(np.uint8)
-        
-        # 转换为PIL图像
-        if len(numpy_image.shape) == 2:
-            # 灰度图像
-            pil_image = Image.fromarray(numpy_image, mode='L').convert('RGB')
-        elif numpy_image.shape[2] == 1:
-            # 单通道图像
-            pil_image = Image.fromarray(numpy_image.squeeze(), mode='L').convert('RGB')
-        else:
-            # RGB图像
-            pil_image = Image.fromarray(numpy_image, mode='RGB')
-        
-        return pil_image
-    
-    def pil_to_tensor(self, pil_image):
-        """将PIL图像转换为tensor"""
-        # 确保是RGB模式
-        if pil_image.mode != 'RGB':
-            pil_image = pil_image.convert('RGB')
-        
-        # 转换为numpy数组
-        numpy_image = np.array(pil_image).astype(np.float32)
-        
-        # 归一化到0-1范围
-        numpy_image = numpy_image / 255.0
-        
-        # 转换为tensor [H, W, C]
-        tensor = torch.from_numpy(numpy_image)
-        
-        # 添加批次维度 [1, H, W, C]
-        tensor = tensor.unsqueeze(0)
-        
-        return tensor
+
+
+def scaled_size(size, scale):
+    """缩放后的尺寸：各边乘以 scale 后向下取整，至少为 1 像素"""
+    return max(1, int(size[0] * scale)), max(1, int(size[1] * scale))
+
+
+def transform_matrix(size, scale, rotation):
+    """旋转 + 缩放后坐标 -> 原图坐标 的仿射矩阵，返回 (matrix, 缩放后画布尺寸)"""
+    matrix, (rotated_width, rotated_height) = rotation_matrix(size, rotation)
+    scaled_width, scaled_height = scaled_size((rotated_width, rotated_height), scale)
+    matrix = compose_affine(matrix, rotated_width / scaled_width, rotated_height / scaled_height)
+    return matrix, (scaled_width, scaled_height)
+
+
+def compose_affine(matrix, scale_x, scale_y, offset_x=0.0, offset_y=0.0):
+    """在仿射矩阵之前先应用 (x, y) -> (x * scale_x + offset_x, y * scale_y + offset_y)"""
+    a, b, c, d, e, f = matrix
+    return [
+        a * scale_x, b * scale_y, a * offset_x + b * offset_y + c,
+        d * scale_x, e * scale_y, d * offset_x + e * offset_y + f,
+    ]
+
+
+def prefilter_factor(matrix):
+    """
+    预滤波倍数：每个输出像素覆盖的原图像素边长取整
+    缩小超过 2 倍时先用 reduce 做整数倍盒式缩小，剩余的双三次采样缩小不超过 2 倍，避免混叠
+    """
+    a, b, _, d, e, _ = matrix
+    return max(1, int(math.sqrt(abs(a * e - b * d))))
+
+
+def affine_sample(pil_image, matrix, size, fillcolor=(0, 0, 0)):
+    """按逆向仿射矩阵（输出坐标 -> 输入坐标）双三次采样出 size 大小的图像（必要时先预滤波）"""
+    factor = prefilter_factor(matrix)
+    if factor > 1:
+        pil_image = pil_image.reduce(factor)
+        matrix = [v / factor for v in matrix]
+    return pil_image.transform(size, Image.Transform.AFFINE, matrix,
+                               resample=Image.Resampling.BICUBIC, fillcolor=fillcolor)
+
+
+def rotation_matrix(size, rotation):
+    """
+    与 PIL Image.rotate(-rotation, expand=True) 相同的逆向仿射矩阵（旋转后坐标 -> 原图坐标）
+    返回 (matrix, 旋转后画布尺寸)
+    """
+    width, height = size
+    angle = math.radians(rotation)
+    cos_a = round(math.cos(angle), 15)
+    sin_a = round(math.sin(angle), 15)
+    matrix = [cos_a, sin_a, 0.0, -sin_a, cos_a, 0.0]
+
+    def apply(x, y):
+        return matrix[0] * x + matrix[1] * y + matrix[2], matrix[3] * x + matrix[4] * y + matrix[5]
+
+    # 绕图像中心旋转
+    center_x, center_y = width / 2.0, height / 2.0
+    matrix[2], matrix[5] = apply(-center_x, -center_y)
+    matrix[2] += center_x
+    matrix[5] += center_y
+
+    # 扩展画布以容纳整张旋转后的图像
+    xs, ys = zip(*(apply(x, y) for x, y in ((0, 0), (width, 0), (width, height), (0, height))))
+    new_width = math.ceil(max(xs)) - math.floor(min(xs))
+    new_height = math.ceil(max(ys)) - math.floor(min(ys))
+    matrix[2], matrix[5] = apply(-(new_width - width) / 2.0, -(new_height - height) / 2.0)
+    return matrix, (new_width, new_height)
 
 
 # 节点映射
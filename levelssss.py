@@ -1,7 +1,9 @@
-import torch
 import numpy as np
-from PIL import Image
 import json
+import functools
+from .lut_utils import apply_luts_tensor, FLOAT_LUT_SIZE
+from .color_lut import ColorLUT, grade_stage
+from .result_cache import cached_result, inputs_fingerprint
 
 class LevelsPanel:
     """
@@ -15,7 +17,6 @@ class LevelsPanel:
     def INPUT_TYPES(cls):
         return {
             "required": {
-                "image": ("IMAGE",),
                 "channel": ("STRING", {
                     "default": "RGB",
                     "choices": ["RGB", "R", "G", "B"]
@@ -31,26 +32,39 @@ class LevelsPanel:
                     }),
                     "display": "hidden"
                 }),
+            },
+            "optional": {
+                # 待调色的图像：接入 color_lut 时必须是调色链的原始图像（连接上一级的 output_image 会重复调色，直接报错）；
+                # 不连接时只组合 LUT、不处理像素，链中间级留空即可让整条链只遍历一次像素
+                "image": ("IMAGE",),
+                # 8bit: 256 项查找表（与面板预览一致）；float: 高精度浮点查找表，直接插值浮点图像
+                "lut_precision": (["8bit", "float"], {
+                    "default": "8bit"
+                }),
+                # 上游曲线/色阶节点输出的合成 LUT；接入后 image 视为整条调色链的原始输入，
+                # 本节点把上游 LUT 与本级组合后只对图像做一次像素遍历
+                "color_lut": ("COLOR_LUT",),
             }
         }
 
-    RETURN_TYPES = ("IMAGE", "IMAGE")
-    RETURN_NAMES = ("output_image", "preview_image")
+    RETURN_TYPES = ("IMAGE", "IMAGE", "COLOR_LUT")
+    RETURN_NAMES = ("output_image", "preview_image", "color_lut")
     FUNCTION = "adjust_image"
     CATEGORY = "🔵BB image crop"
 
-    def adjust_image(self, image, channel="RGB", levels_params=None):
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        """控件值的指纹（ComfyUI 调用时只传入控件值，不含连线输入；连线输入是否变化由 ComfyUI 按上游节点判断）"""
+        return inputs_fingerprint(kwargs)
+
+    @cached_result
+    def adjust_image(self, channel="RGB", levels_params=None, lut_precision="8bit", color_lut=None, image=None):
         """
-        应用色阶调整并返回 (output_tensor, preview_tensor)
+        应用色阶调整并返回 (output_tensor, preview_tensor, color_lut)
         preview 为缩小后的实时预览
         """
         if levels_params is None:
             levels_params = {}
-        # 转换到PIL
-        if len(image.shape) == 4:
-            pil_image = self.tensor_to_pil(image[0])
-        else:
-            pil_image = self.tensor_to_pil(image)
 
         # 解析参数，构建查找表
         try:
@@ -58,131 +72,123 @@ class LevelsPanel:
         except Exception:
             params = {}
 
-        lut_r, lut_g, lut_b = self.build_luts_from_params(params, channel)
-
-        result = self.apply_luts(pil_image, lut_r, lut_g, lut_b)
-
-        # 生成预览图（缩小）
-        preview = result.copy()
-        preview.thumbnail((min(512, preview.width), min(512, preview.height)), Image.Resampling.LANCZOS)
+        lut_size = FLOAT_LUT_SIZE if lut_precision == "float" else None
+        lut_r, lut_g, lut_b = self.build_luts_from_params(params, channel, lut_size)
 
-        out_tensor = self.pil_to_tensor(result)
-        preview_tensor = self.pil_to_tensor(preview)
+        # 未接入上游 LUT 时直接在 tensor 上对整个批次应用本级查找表
+        stage_lut = ColorLUT.from_luts(lut_r, lut_g, lut_b)
+        return grade_stage(image, color_lut, stage_lut, lambda frames: self.apply_luts(frames, lut_r, lut_g, lut_b))
 
-        return (out_tensor, preview_tensor)
-
-    def build_luts_from_params(self, params, channel):
+    def build_luts_from_params(self, params, channel, lut_size=None):
         """
         根据 levels 参数（JSON 结构或缺省）为每个通道生成 256 长度的 LUT（uint8）
-        Photoshop 风格处理顺序（简化）：先对单通道(in/out/gamma)处理，再在需要时使用 RGB 复合（这里保持与单通道一致的接口）
+        lut_size 为整数时改为生成 lut_size 项 float32 LUT（0-1，不做 8 位量化）
         params: dict，包含 "RGB","R","G","B" 的子字典
+        相同参数（规范化后）的编译结果走 LRU 缓存，逐帧参数动画中重复的取值只需一次字典查找
         """
-        def get_chan_param(ch):
-            # in_mid treated as midpoint input (1..254), default 128
-            default = {"in_black":0,"in_mid":128,"in_white":255,"out_black":0,"out_white":255}
-            try:
-                return { **default, **(params.get(ch, {}) if isinstance(params, dict) else {}) }
-            except Exception:
-                return default
-
-        # 对指定通道构建 LUT
-        def make_lut(p):
-            ib = float(p.get("in_black", 0))
-            im = float(p.get("in_mid", 1.0))
-            iw = float(p.get("in_white", 255))
-            ob = float(p.get("out_black", 0))
-            ow = float(p.get("out_white", 255))
-
-            # 防止除零
-            denom = iw - ib
-            if denom == 0:
-                denom = 1.0
-
-            # 使用 Photoshop 风格的中点->gamma 映射：
-            # in_mid 被视为输入取值（介于 ib+1 与 iw-1 之间）应映射为 0.5 输出。
-            # 计算 gamma 使得 ( (mid - ib)/(iw-ib) )**gamma = 0.5
-            try:
-                mid = max(ib + 1.0, min(iw - 1.0, im))
-                mid_norm = (mid - ib) / denom
-                if mid_norm > 0.0 and mid_norm < 1.0:
-                    gamma = float(np.log(0.5) / np.log(mid_norm))
-                else:
-                    gamma = 1.0
-            except Exception:
-                gamma = 1.0
+        return _compile_levels_luts(normalize_levels_params(params), channel, lut_size)
 
-            lut = np.zeros(256, dtype=np.uint8)
-            for v in range(256):
-                normalized = (v - ib) / denom
-                if not np.isfinite(normalized):
-                    normalized = 0.0
-                normalized = float(max(0.0, min(1.0, normalized)))
-                mapped = float(np.power(normalized, gamma)) if normalized > 0 else 0.0
-                outv = ob + mapped * (ow - ob)
-                outv = int(round(max(0, min(255, outv))))
-                lut[v] = np.uint8(outv)
-            return lut
-
-        # 若 params 中包含 JSON 风格的多通道配置，优先使用对应通道
-        lut_rgb = make_lut(get_chan_param("RGB"))
-        lut_r = make_lut(get_chan_param("R"))
-        lut_g = make_lut(get_chan_param("G"))
-        lut_b = make_lut(get_chan_param("B"))
-
-        # 统一采用“先应用 RGB 整体调整，再应用单通道调整”的管线，确保前后端预览/输出一致
-        combined_lut_r = np.zeros(256, dtype=np.uint8)
-        combined_lut_g = np.zeros(256, dtype=np.uint8)
-        combined_lut_b = np.zeros(256, dtype=np.uint8)
-        for i in range(256):
-            # 先通过 RGB LUT 映射，再对结果应用对应的单通道 LUT（即 lut_chan(lut_rgb[i])）
-            v_rgb = lut_rgb[i]
-            combined_lut_r[i] = lut_r[v_rgb]
-            combined_lut_g[i] = lut_g[v_rgb]
-            combined_lut_b[i] = lut_b[v_rgb]
-        return combined_lut_r, combined_lut_g, combined_lut_b
-
-    def apply_luts(self, pil_image, lut_r, lut_g, lut_b):
+    def apply_luts(self, images, lut_r, lut_g, lut_b):
         """
-        使用 PIL point 映射应用 LUTs
+        在 IMAGE 批次 [B, H, W, C] 上直接应用三通道查找表（torch 索引，一次处理所有帧）
         """
-        if pil_image.mode != "RGB":
-            img = pil_image.convert("RGB")
-        else:
-            img = pil_image
-
-        r, g, b = img.split()
-        r = r.point(list(lut_r))
-        g = g.point(list(lut_g))
-        b = b.point(list(lut_b))
-        return Image.merge("RGB", (r, g, b))
-
-    def tensor_to_pil(self, tensor):
-        """与项目中其他节点保持一致的 tensor -> PIL 转换"""
-        if len(tensor.shape) == 3:
-            if tensor.shape[0] == 3 or tensor.shape[0] == 1:
-                tensor = tensor.permute(1, 2, 0)
-
-        tensor = torch.clamp(tensor, 0, 1)
-        numpy_image = tensor.cpu().numpy()
-        numpy_image = (numpy_image * 255).astype(np.uint8)
-
-        if len(numpy_image.shape) == 2:
-            pil_image = Image.fromarray(numpy_image, mode='L').convert('RGB')
-        elif numpy_image.shape[2] == 1:
-            pil_image = Image.fromarray(numpy_image.squeeze(), mode='L').convert('RGB')
-        else:
-            pil_image = Image.fromarray(numpy_image, mode='RGB')
-        return pil_image
-
-    def pil_to_tensor(self, pil_image):
-        """与项目中其他节点保持一致的 PIL -> tensor 转换"""
-        if pil_image.mode != 'RGB':
-            pil_image = pil_image.convert('RGB')
-        numpy_image = np.array(pil_image).astype(np.float32)
-        numpy_image = numpy_image / 255.0
-        tensor = torch.from_numpy(numpy_image)
-        tensor = tensor.unsqueeze(0)
-        return tensor
+        return apply_luts_tensor(images, lut_r, lut_g, lut_b)
+
+
+
+# 色阶编译结果缓存的容量（每项为三张查找表）
+LEVELS_CACHE_SIZE = 256
+
+
+def normalize_levels_params(params):
+    """将色阶参数规范化为缓存键（按键排序的紧凑 JSON），语义相同的参数得到同一个键"""
+    try:
+        return json.dumps(params, sort_keys=True, separators=(',', ':'))
+    except Exception:
+        return json.dumps({})
+
+
+def levels_cache_info():
+    """色阶编译缓存的命中统计（hits/misses/maxsize/currsize），用于监控"""
+    return _compile_levels_luts.cache_info()
+
+
+@functools.lru_cache(maxsize=LEVELS_CACHE_SIZE)
+def _compile_levels_luts(params_key, channel, lut_size):
+    """
+    将（规范化后的）色阶参数编译为三通道查找表，结果被缓存，返回只读数组
+    Photoshop 风格处理顺序（简化）：先对单通道(in/out/gamma)处理，再在需要时使用 RGB 复合（这里保持与单通道一致的接口）
+    """
+    params = json.loads(params_key)
+
+    def get_chan_param(ch):
+        # in_mid treated as midpoint input (1..254), default 128
+        default = {"in_black":0,"in_mid":128,"in_white":255,"out_black":0,"out_white":255}
+        try:
+            return { **default, **(params.get(ch, {}) if isinstance(params, dict) else {}) }
+        except Exception:
+            return default
+
+    # 8 位模式取 0-255 整数输入；浮点模式在 0-255 上均匀采样，保留小数精度
+    if lut_size is None:
+        values = np.arange(256, dtype=np.float64)
+    else:
+        values = np.linspace(0.0, 255.0, lut_size)
+
+    # 对指定通道构建 LUT（整表一次数组运算）
+    def make_lut(p):
+        ib = float(p.get("in_black", 0))
+        im = float(p.get("in_mid", 1.0))
+        iw = float(p.get("in_white", 255))
+        ob = float(p.get("out_black", 0))
+        ow = float(p.get("out_white", 255))
+
+        # 防止除零
+        denom = iw - ib
+        if denom == 0:
+            denom = 1.0
+
+        # 使用 Photoshop 风格的中点->gamma 映射：
+        # in_mid 被视为输入取值（介于 ib+1 与 iw-1 之间）应映射为 0.5 输出。
+        # 计算 gamma 使得 ( (mid - ib)/(iw-ib) )**gamma = 0.5
+        try:
+            mid = max(ib + 1.0, min(iw - 1.0, im))
+            mid_norm = (mid - ib) / denom
+            if mid_norm > 0.0 and mid_norm < 1.0:
+                gamma = float(np.log(0.5) / np.log(mid_norm))
+            else:
+                gamma = 1.0
+        except Exception:
+            gamma = 1.0
+
+        with np.errstate(invalid='ignore', divide='ignore'):
+            normalized = (values - ib) / denom
+            normalized = np.where(np.isfinite(normalized), normalized, 0.0)
+            normalized = np.clip(normalized, 0.0, 1.0)
+            mapped = np.where(normalized > 0, np.power(normalized, gamma), 0.0)
+        outv = ob + mapped * (ow - ob)
+
+        if lut_size is None:
+            return np.round(np.clip(outv, 0, 255)).astype(np.uint8)
+        return np.clip(outv / 255.0, 0.0, 1.0).astype(np.float32)
+
+    # 若 params 中包含 JSON 风格的多通道配置，优先使用对应通道
+    lut_rgb = make_lut(get_chan_param("RGB"))
+    lut_r = make_lut(get_chan_param("R"))
+    lut_g = make_lut(get_chan_param("G"))
+    lut_b = make_lut(get_chan_param("B"))
+
+    # 统一采用“先应用 RGB 整体调整，再应用单通道调整”的管线，确保前后端预览/输出一致
+    # 即 lut_chan(lut_rgb[i])：8 位模式用索引组合，浮点模式用线性插值组合
+    if lut_size is None:
+        combined = (lut_r[lut_rgb], lut_g[lut_rgb], lut_b[lut_rgb])
+    else:
+        grid = np.linspace(0.0, 1.0, lut_size)
+        combined = tuple(np.interp(lut_rgb, grid, lut).astype(np.float32) for lut in (lut_r, lut_g, lut_b))
+
+    for lut in combined:
+        lut.flags.writeable = False
+    return combined
 
 
 # 节点映射（前端 nodeData.name 可能为 "levelssss"，因此映射用该键）
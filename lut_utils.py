@@ -0,0 +1,135 @@
+import os
+import torch
+import numpy as np
+from .image_utils import rgb_channels
+
+
+# 三个通道在扁平查找表中的起始偏移
+_CHANNEL_OFFSETS = torch.tensor([0, 256, 512], dtype=torch.int32)
+
+# 浮点模式查找表的默认项数
+FLOAT_LUT_SIZE = 4096
+
+# 每次处理的像素数：中间缓冲区保持在 CPU 缓存内，减少整帧内存往返
+_PIXEL_CHUNK = 1 << 16
+
+# 超大图像按横向条带处理时每个条带的临时内存上限（MB，环境变量 BB_COLOR_STRIP_MB）
+COLOR_STRIP_MB = int(os.environ.get("BB_COLOR_STRIP_MB", 64))
+
+
+def luts_to_table(lut_r, lut_g, lut_b):
+    """三通道 uint8 查找表 -> 扁平 float32 表 [3 * 256]（0-1 范围）"""
+    table = np.concatenate([lut_r, lut_g, lut_b]).astype(np.float32)
+    return torch.from_numpy(table).div_(255.0)
+
+
+def iter_strips(images, bytes_per_pixel):
+    """
+    将 [B, H, W, C] 按整行切分为横向条带，产生 (帧序号, 起始行, 结束行)
+    每条带的临时内存（bytes_per_pixel * 宽 * 行数）不超过 COLOR_STRIP_MB
+    """
+    batch, height, width = images.shape[:3]
+    rows = max(1, COLOR_STRIP_MB * 1024 * 1024 // max(1, width * bytes_per_pixel))
+    for index in range(batch):
+        for top in range(0, height, rows):
+            yield index, top, min(height, top + rows)
+
+
+def map_strips(images, process):
+    """
+    按横向条带处理 IMAGE tensor，结果写入预分配的 float32 [..., 3] 输出
+    process(pixels, dst): pixels 为条带的 [N, C] 像素（已在 CPU 上），dst 为输出中对应的 [N, 3] 视图
+    GPU / 非连续输入只按条带拷贝，峰值内存约为 输入 + 输出 + 一个条带
+    """
+    shape = images.shape[:-1]
+    images = images.reshape(-1, *images.shape[-3:]) if images.dim() >= 3 else images[None, None]
+    out = torch.empty((*images.shape[:3], 3), dtype=torch.float32)
+    # 条带拷贝（输入类型）+ 输出，按 float32 估算
+    bytes_per_pixel = images.shape[-1] * images.element_size() + 3 * 4
+    for index, top, bottom in iter_strips(images, bytes_per_pixel):
+        strip = images[index, top:bottom]
+        if strip.device.type != "cpu":
+            strip = strip.cpu()
+        process(strip.reshape(-1, strip.shape[-1]), out[index, top:bottom].view(-1, 3))
+    return out.view(*shape, 3)
+
+
+def apply_luts_tensor(images, lut_r, lut_g, lut_b):
+    """
+    直接在 IMAGE tensor [B, H, W, C] 上应用三通道查找表
+    - uint8 查找表走索引路径；浮点查找表走线性插值路径（见 apply_float_luts_tensor）
+    - 浮点输入按 clamp(0,1) * 255 截断量化为索引（与 tensor_to_pil 一致，结果逐位相同）
+    - 三个通道合并为一次 index_select，按条带、再按像素分块处理，中间缓冲区常驻缓存
+    返回 float32 [B, H, W, 3]
+    """
+    if lut_r.dtype != np.uint8:
+        return apply_float_luts_tensor(images, lut_r, lut_g, lut_b)
+
+    table = luts_to_table(lut_r, lut_g, lut_b)
+    scratch = torch.empty((_PIXEL_CHUNK, 3), dtype=torch.float32)
+    index = torch.empty((_PIXEL_CHUNK, 3), dtype=torch.int32)
+
+    def process(pixels, dst):
+        total = pixels.shape[0]
+        for start in range(0, total, _PIXEL_CHUNK):
+            end = min(total, start + _PIXEL_CHUNK)
+            src = rgb_channels(pixels[start:end])
+            idx = index[:end - start]
+            if src.dtype == torch.uint8:
+                idx.copy_(src)
+            else:
+                buf = scratch[:end - start]
+                torch.mul(src, 255.0, out=buf)
+                buf.clamp_(0, 255)
+                idx.copy_(buf)
+            idx += _CHANNEL_OFFSETS
+            torch.index_select(table, 0, idx.view(-1), out=dst[start:end].view(-1))
+
+    return map_strips(images, process)
+
+
+def apply_float_luts_tensor(images, lut_r, lut_g, lut_b):
+    """
+    在 IMAGE tensor 上应用三通道浮点查找表（0-1 值域，任意项数）
+    输入不经 uint8 量化，按 clamp(0,1) 后在表项之间线性插值，避免多级调整叠加时的色带
+    返回 float32 [B, H, W, 3]
+    """
+    size = len(lut_r)
+    tables = torch.from_numpy(np.stack([lut_r, lut_g, lut_b]).astype(np.float32))
+    # 每个区间的斜率，末项补零使插值在 x=1 处取到最后一项
+    slopes = torch.zeros_like(tables)
+    slopes[:, :-1] = tables[:, 1:] - tables[:, :-1]
+    tables = tables.reshape(-1)
+    slopes = slopes.reshape(-1)
+    offsets = torch.arange(3, dtype=torch.int32) * size
+
+    position = torch.empty((_PIXEL_CHUNK, 3), dtype=torch.float32)
+    index = torch.empty((_PIXEL_CHUNK, 3), dtype=torch.int32)
+    slope = torch.empty(_PIXEL_CHUNK * 3, dtype=torch.float32)
+
+    def process(pixels, dst_pixels):
+        total = pixels.shape[0]
+        for start in range(0, total, _PIXEL_CHUNK):
+            end = min(total, start + _PIXEL_CHUNK)
+            src = rgb_channels(pixels[start:end])
+            pos = position[:end - start]
+            idx = index[:end - start]
+            if src.dtype == torch.uint8:
+                pos.copy_(src)
+                pos.div_(255.0)
+            else:
+                pos.copy_(src)
+            pos.clamp_(0, 1)
+            pos.mul_(size - 1)
+            # 整数部分为表项索引，小数部分为插值权重
+            idx.copy_(pos)
+            pos.sub_(idx)
+            idx += offsets
+
+            flat_idx = idx.view(-1)
+            dst = dst_pixels[start:end].view(-1)
+            torch.index_select(tables, 0, flat_idx, out=dst)
+            torch.index_select(slopes, 0, flat_idx, out=slope[:flat_idx.numel()])
+            dst.addcmul_(slope[:flat_idx.numel()], pos.view(-1))
+
+    return map_strips(images, process)
@@ -0,0 +1,61 @@
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+
+
+# 共享线程池的线程数（环境变量 BB_THREADS，未设置时取 CPU 核数）
+THREAD_COUNT = max(1, int(os.environ.get("BB_THREADS", 0) or 0) or os.cpu_count() or 1)
+
+# 大图分块并行的最小像素数（更小的图像分块开销大于收益）
+TILE_MIN_PIXELS = 1 << 20
+
+_THREAD_PREFIX = "bb_image_worker"
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    """返回（必要时创建）所有节点共享的线程池"""
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=THREAD_COUNT, thread_name_prefix=_THREAD_PREFIX)
+        return _executor
+
+
+def _in_worker():
+    return threading.current_thread().name.startswith(_THREAD_PREFIX)
+
+
+def parallel_map(func, items):
+    """
+    返回 [func(item) for item in items]，结果顺序与输入一致
+    PIL 的 resize/rotate/transform/reduce 以及 cv2 的变换在计算时会释放 GIL，多帧/多块可真正并行
+    单线程、只有一个元素或已在线程池内部调用时（避免嵌套等待）直接串行执行
+    """
+    items = list(items)
+    if THREAD_COUNT <= 1 or len(items) <= 1 or _in_worker():
+        return [func(item) for item in items]
+    return list(get_executor().map(func, items))
+
+
+def tiled_reduce(pil_image, factor):
+    """
+    整数倍盒式缩小（Image.reduce），大图按行分块并行
+    块边界对齐到 factor 的整数倍，每个输出像素的采样块与整图 reduce 完全相同，结果逐位一致
+    """
+    width, height = pil_image.size
+    tiles = min(THREAD_COUNT, -(-height // factor))
+    if factor <= 1 or tiles <= 1 or width * height < TILE_MIN_PIXELS or _in_worker():
+        return pil_image.reduce(factor) if factor > 1 else pil_image
+
+    rows = factor * -(-height // (factor * tiles))
+    bands = [(top, min(height, top + rows)) for top in range(0, height, rows)]
+    parts = parallel_map(lambda band: pil_image.crop((0, band[0], width, band[1])).reduce(factor), bands)
+
+    result = Image.new(pil_image.mode, (-(-width // factor), -(-height // factor)))
+    for (top, _), part in zip(bands, parts):
+        result.paste(part, (0, top // factor))
+    return result
@@ -1,7 +1,19 @@
-import torch
 import numpy as np
-from PIL import Image, ImageDraw, ImageFont
+from PIL import ImageDraw, ImageFont
 import math
+import json
+from .image_utils import pil_to_tensor, as_batch
+from .preview_utils import preview_canvas
+from .parallel_utils import parallel_map
+from .quad_utils import QUAD_MIN_CONFIDENCE, detect_document_quad
+from .result_cache import cached_result, inputs_fingerprint
+from .warp_utils import WARP_MODES, solve_homography, solve_homographies, warp_perspective, warp_perspective_sequence
+
+# 输出尺寸上限；大输出按块生成（见 warp_utils.use_tiles），内存占用有界
+MAX_OUTPUT_SIZE = 16384
+
+# 角点坐标范围（原图像素），覆盖大尺寸扫描件
+COORDINATE_LIMIT = 16384.0
 
 class PerspectiveCropWithPanel:
     """
@@ -16,57 +28,57 @@ class PerspectiveCropWithPanel:
                 "image": ("IMAGE",),
                 "top_left_x": ("FLOAT", {
                     "default": 100.0,
-                    "min": -4096.0,
-                    "max": 4096.0,
+                    "min": -COORDINATE_LIMIT,
+                    "max": COORDINATE_LIMIT,
                     "step": 1.0,
                     "display": "hidden"
                 }),
                 "top_left_y": ("FLOAT", {
                     "default": 100.0,
-                    "min": -4096.0,
-                    "max": 4096.0,
+                    "min": -COORDINATE_LIMIT,
+                    "max": COORDINATE_LIMIT,
                     "step": 1.0,
                     "display": "hidden"
                 }),
                 "top_right_x": ("FLOAT", {
                     "default": 300.0,
-                    "min": -4096.0,
-                    "max": 4096.0,
+                    "min": -COORDINATE_LIMIT,
+                    "max": COORDINATE_LIMIT,
                     "step": 1.0,
                     "display": "hidden"
                 }),
                 "top_right_y": ("FLOAT", {
                     "default": 100.0,
-                    "min": -4096.0,
-                    "max": 4096.0,
+                    "min": -COORDINATE_LIMIT,
+                    "max": COORDINATE_LIMIT,
                     "step": 1.0,
                     "display": "hidden"
                 }),
                 "bottom_left_x": ("FLOAT", {
                     "default": 100.0,
-                    "min": -4096.0,
-                    "max": 4096.0,
+                    "min": -COORDINATE_LIMIT,
+                    "max": COORDINATE_LIMIT,
                     "step": 1.0,
                     "display": "hidden"
                 }),
                 "bottom_left_y": ("FLOAT", {
                     "default": 300.0,
-                    "min": -4096.0,
-                    "max": 4096.0,
+                    "min": -COORDINATE_LIMIT,
+                    "max": COORDINATE_LIMIT,
                     "step": 1.0,
                     "display": "hidden"
                 }),
                 "bottom_right_x": ("FLOAT", {
                     "default": 300.0,
-                    "min": -4096.0,
-                    "max": 4096.0,
+                    "min": -COORDINATE_LIMIT,
+                    "max": COORDINATE_LIMIT,
                     "step": 1.0,
                     "display": "hidden"
                 }),
                 "bottom_right_y": ("FLOAT", {
                     "default": 300.0,
-                    "min": -4096.0,
-                    "max": 4096.0,
+                    "min": -COORDINATE_LIMIT,
+                    "max": COORDINATE_LIMIT,
                     "step": 1.0,
                     "display": "hidden"
                 }),
@@ -78,18 +90,41 @@ class PerspectiveCropWithPanel:
                 "output_width": ("INT", {
                     "default": 512,
                     "min": 64,
-                    "max": 2048,
+                    "max": MAX_OUTPUT_SIZE,
                     "step": 8
                 }),
                 "output_height": ("INT", {
                     "default": 512,
                     "min": 64,
-                    "max": 2048,
+                    "max": MAX_OUTPUT_SIZE,
                     "step": 8
                 }),
                 "fill_color": (["black", "white", "transparent"], {
                     "default": "black"
                 }),
+            },
+            "optional": {
+                # 采样方式：bilinear 与 cv2.warpPerspective 默认一致；bicubic 更锐利
+                "interpolation": (WARP_MODES, {
+                    "default": "bilinear"
+                }),
+                # 逐帧角点轨迹（视频批次）：JSON 关键帧 {"帧号": 角点} / [{"frame": n, "corners": 角点}]，
+                # 或逐帧角点列表 [角点, 角点, ...]；角点为 [[x, y] x 4]，顺序 左上、右上、右下、左下
+                # 关键帧之间线性插值，首尾之外保持端点值；留空时所有帧使用面板角点
+                "corner_track": ("STRING", {
+                    "default": "",
+                    "multiline": True
+                }),
+                # manual：使用面板角点 / 角点轨迹；auto：逐帧自动检测文档四边形，
+                # 置信度不足的帧回退到面板角点（或角点轨迹）
+                "corner_mode": (["manual", "auto"], {
+                    "default": "manual"
+                }),
+                # 抗锯齿：输出比原图小（缩小）的区域从 mipmap 金字塔对应层级采样，避免摩尔纹和锯齿；
+                # 放大区域不受影响
+                "antialias": ("BOOLEAN", {
+                    "default": True
+                }),
             }
         }
     
@@ -98,18 +133,19 @@ class PerspectiveCropWithPanel:
     FUNCTION = "perspective_crop"
     CATEGORY = "🔵BB image crop"
     
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        """控件值的指纹（ComfyUI 调用时只传入控件值，不含连线输入；连线输入是否变化由 ComfyUI 按上游节点判断）"""
+        return inputs_fingerprint(kwargs)
+    
+    @cached_result(disk=True)
     def perspective_crop(self, image, top_left_x, top_left_y, top_right_x, top_right_y,
                         bottom_left_x, bottom_left_y, bottom_right_x, bottom_right_y,
-                        auto_size, output_width, output_height, fill_color):
+                        auto_size, output_width, output_height, fill_color, interpolation="bilinear",
+                        corner_track="", corner_mode="manual", antialias=True):
         """
         透视剪裁主函数
         """
-        # 转换tensor到PIL图像
-        if len(image.shape) == 4:
-            pil_image = self.tensor_to_pil(image[0])
-        else:
-            pil_image = self.tensor_to_pil(image)
-        
         # 使用用户在面板中点击的角点
         src_points = np.array([
             [top_left_x, top_left_y],           # 左上
@@ -118,9 +154,19 @@ class PerspectiveCropWithPanel:
             [bottom_left_x, bottom_left_y]      # 左下
         ], dtype=np.float32)
         
-        # 如果启用自适应尺寸，计算最佳输出尺寸
+        batch = as_batch(image)
+        # 逐帧角点 [B, 4, 2]；没有轨迹时为 None，所有帧共用面板角点
+        frame_points = parse_corner_track(corner_track, batch.shape[0])
+        if corner_mode == "auto":
+            frame_points = self.detect_corners(batch, src_points if frame_points is None else frame_points)
+        
+        # 如果启用自适应尺寸，计算最佳输出尺寸（有轨迹时取各帧的最大值，保证整段序列尺寸一致）
         if auto_size:
-            output_width, output_height = self.calculate_adaptive_size(src_points)
+            if frame_points is None:
+                output_width, output_height = self.calculate_adaptive_size(src_points)
+            else:
+                sizes = [self.calculate_adaptive_size(points) for points in frame_points]
+                output_width, output_height = max(w for w, _ in sizes), max(h for _, h in sizes)
         
         # 定义目标矩形的四个角点
         dst_points = np.array([
@@ -130,19 +176,22 @@ class PerspectiveCropWithPanel:
             [0, output_height]                # 左下
         ], dtype=np.float32)
         
-        # 执行透视变换
-        transformed_image = self.apply_perspective_transform(
-            pil_image, src_points, dst_points, output_width, output_height, fill_color
-        )
-        
-        # 生成预览图像
-        preview_image = self.create_preview(
-            pil_image, src_points
-        )
+        if frame_points is None:
+            # 整个批次一次 grid_sample 完成透视变换，所有帧使用相同的角点
+            inverse = self.output_to_source(src_points, dst_points, batch.shape[2], batch.shape[1])
+            cropped_tensor = warp_perspective(batch, inverse, output_width, output_height, interpolation, fill_color,
+                                             antialias=antialias)
+        else:
+            # 所有帧的单应矩阵批量求解，整段序列一次 grid_sample
+            inverses = self.track_to_source(frame_points, dst_points, batch.shape[2], batch.shape[1])
+            cropped_tensor = warp_perspective_sequence(batch, inverses, output_width, output_height, interpolation,
+                                                      fill_color, antialias=antialias)
         
-        # 转换回tensor
-        cropped_tensor = self.pil_to_tensor(transformed_image)
-        preview_tensor = self.pil_to_tensor(preview_image)
+        # 生成预览图像（在缩小的代理图上绘制第一帧的透视四边形）
+        preview, factor = preview_canvas(batch)
+        preview_points = src_points if frame_points is None else frame_points[0]
+        preview_image = self.create_preview(preview, preview_points * factor)
+        preview_tensor = pil_to_tensor(preview_image)
         
         return (cropped_tensor, preview_tensor)
     
@@ -162,7 +211,7 @@ class PerspectiveCropWithPanel:
         
         # 确保尺寸在合理范围内
         min_size = 64
-        max_size = 2048
+        max_size = MAX_OUTPUT_SIZE
         
         output_width = max(min_size, min(max_size, avg_width))
         output_height = max(min_size, min(max_size, avg_height))
@@ -173,112 +222,39 @@ class PerspectiveCropWithPanel:
         
         return output_width, output_height
     
-    def apply_perspective_transform(self, image, src_points, dst_points, width, height, fill_color):
+    def output_to_source(self, src_points, dst_points, source_width, source_height):
         """
-        应用透视变换
+        输出坐标 -> 原图坐标 的单应矩阵
+        角点退化（三点共线）时退化为把整张原图缩放到输出尺寸
         """
         try:
-            # 尝试使用 OpenCV（如果可用）
-            import cv2
-            
-            # 转换PIL图像为numpy数组
-            img_array = np.array(image)
-            
-            # 确保点的顺序正确：左上、右上、右下、左下
-            src_pts = np.float32(src_points)
-            dst_pts = np.float32(dst_points)
-            
-            # 计算透视变换矩阵
-            matrix = cv2.getPerspectiveTransform(src_pts, dst_pts)
-            
-            # 应用透视变换
-            if fill_color == "white":
-                borderValue = (255, 255, 255)
-            elif fill_color == "transparent":
-                borderValue = (0, 0, 0, 0)
-                # 确保图像有alpha通道
-                if len(img_array.shape) == 3 and img_array.shape[2] == 3:
-                    alpha = np.ones((img_array.shape[0], img_array.shape[1], 1), dtype=img_array.dtype) * 255
-                    img_array = np.concatenate([img_array, alpha], axis=2)
-            else:
-                borderValue = (0, 0, 0)
-            
-            transformed = cv2.warpPerspective(
-                img_array, matrix, (width, height),
-                borderMode=cv2.BORDER_CONSTANT,
-                borderValue=borderValue
-            )
-            
-            # 转换回PIL图像
-            if fill_color == "transparent":
-                result_image = Image.fromarray(transformed, 'RGBA')
-            else:
-                result_image = Image.fromarray(transformed, 'RGB')
-                
-        except ImportError:
-            # 如果没有OpenCV，使用简化的实现
-            result_image = self.simple_perspective_transform(
-                image, src_points, dst_points, width, height, fill_color
-            )
-        except Exception as e:
-            # 如果OpenCV变换失败，使用PIL实现
-            result_image = self.simple_perspective_transform(
-                image, src_points, dst_points, width, height, fill_color
-            )
-        
-        return result_image
+            return solve_homography(dst_points, src_points)
+        except ValueError:
+            corners = np.array([[0, 0], [source_width, 0], [source_width, source_height], [0, source_height]], dtype=np.float64)
+            return solve_homography(dst_points, corners)
     
-    def simple_perspective_transform(self, image, src_points, dst_points, width, height, fill_color):
+    def detect_corners(self, images, fallback_points):
         """
-        简化的透视变换实现（当OpenCV不可用时）
-        使用PIL的transform方法
+        逐帧检测文档四边形（缩小的代理图上，共享线程池并行），返回 [B, 4, 2] 角点
+        置信度低于 QUAD_MIN_CONFIDENCE 的帧使用 fallback_points（[4, 2] 或 [B, 4, 2]）
         """
-        # 创建输出图像
-        if fill_color == "white":
-            result_image = Image.new('RGB', (width, height), (255, 255, 255))
-        elif fill_color == "transparent":
-            result_image = Image.new('RGBA', (width, height), (0, 0, 0, 0))
-            if image.mode != 'RGBA':
-                image = image.convert('RGBA')
-        else:
-            result_image = Image.new('RGB', (width, height), (0, 0, 0))
-        
-        try:
-            # 使用PIL的transform方法进行透视变换
-            coeffs = self.find_coeffs(dst_points, src_points)
-            
-            # 应用透视变换
-            transformed = image.transform(
-                (width, height),
-                Image.Transform.PERSPECTIVE,
-                coeffs,
-                Image.Resampling.BICUBIC
-            )
-            
-            return transformed
-            
-        except Exception as e:
-            # 如果变换失败，返回调整大小的原图
-            return image.resize((width, height), Image.Resampling.BICUBIC)
+        detections = parallel_map(detect_document_quad, images)
+        points = np.array(np.broadcast_to(fallback_points, (images.shape[0], 4, 2)), dtype=np.float64)
+        for i, (corners, confidence) in enumerate(detections):
+            if corners is not None and confidence >= QUAD_MIN_CONFIDENCE:
+                points[i] = corners
+        return points
     
-    def find_coeffs(self, pa, pb):
+    def track_to_source(self, frame_points, dst_points, source_width, source_height):
         """
-        计算PIL透视变换系数
+        逐帧 输出坐标 -> 原图坐标 的单应矩阵 [B, 3, 3]，一次批量求解
+        只有个别帧退化时，才逐帧求解并对退化帧使用整图
         """
-        matrix = []
-        for p1, p2 in zip(pa, pb):
-            matrix.append([p1[0], p1[1], 1, 0, 0, 0, -p2[0]*p1[0], -p2[0]*p1[1]])
-            matrix.append([0, 0, 0, p1[0], p1[1], 1, -p2[1]*p1[0], -p2[1]*p1[1]])
-
-        A = np.matrix(matrix, dtype=np.float64)
-        B = np.array(pb).reshape(8)
-
         try:
-            res = np.dot(np.linalg.inv(A.T * A) * A.T, B)
-            return np.array(res).reshape(8)
-        except:
-            # 如果计算失败，返回单位变换
-            return [1, 0, 0, 0, 1, 0, 0, 0]
+            return solve_homographies(dst_points, frame_points)
+        except ValueError:
+            return np.stack([self.output_to_source(points, dst_points, source_width, source_height)
+                             for points in frame_points])
     
     def create_preview(self, image, src_points):
         """
@@ -320,39 +296,46 @@ class PerspectiveCropWithPanel:
             draw.text((x + 12, y - 8), label, fill=(255, 255, 255), font=font)
         
         return preview
-    
-    def tensor_to_pil(self, tensor):
-        """将tensor转换为PIL图像"""
-        if len(tensor.shape) == 3:
-            if tensor.shape[0] == 3 or tensor.shape[0] == 1:
-                tensor = tensor.permute(1, 2, 0)
-        
-        tensor = torch.clamp(tensor, 0, 1)
-        numpy_image = tensor.cpu().numpy()
-        numpy_image = (numpy_image * 255).astype(np.uint8)
-        
-        if len(numpy_image.shape) == 2:
-            pil_image = Image.fromarray(numpy_image, mode='L').convert('RGB')
-        elif numpy_image.shape[2] == 1:
-            pil_image = Image.fromarray(numpy_image.squeeze(), mode='L').convert('RGB')
-        else:
-            pil_image = Image.fromarray(numpy_image, mode='RGB')
-        
-        return pil_image
-    
-    def pil_to_tensor(self, pil_image):
-        """将PIL图像转换为tensor"""
-        if pil_image.mode == 'RGBA':
-            pass
-        elif pil_image.mode != 'RGB':
-            pil_image = pil_image.convert('RGB')
-        
-        numpy_image = np.array(pil_image).astype(np.float32)
-        numpy_image = numpy_image / 255.0
-        tensor = torch.from_numpy(numpy_image)
-        tensor = tensor.unsqueeze(0)
-        
-        return tensor
+
+def _parse_corners(value):
+    """单帧角点 [[x, y] x 4] -> [4, 2] 数组，格式不对时抛出 ValueError"""
+    corners = np.asarray(value, dtype=np.float64)
+    if corners.shape != (4, 2):
+        raise ValueError(f"角点必须是 4 个 [x, y]，实际形状为 {corners.shape}")
+    return corners
+
+
+def parse_corner_track(track, frame_count):
+    """
+    解析角点轨迹，返回 [frame_count, 4, 2] 的逐帧角点；空字符串返回 None
+    - 逐帧列表：[[[x, y] x 4], ...]，帧数不足时最后一帧保持
+    - 关键帧：{"0": 角点, "30": 角点} 或 [{"frame": 0, "corners": 角点}, ...]
+    关键帧之间对每个角点坐标线性插值，第一个关键帧之前 / 最后一个之后保持端点值
+    """
+    if not isinstance(track, str) or not track.strip():
+        return None
+    try:
+        data = json.loads(track)
+    except json.JSONDecodeError as e:
+        raise ValueError(f"corner_track 不是合法的 JSON：{e}")
+
+    if isinstance(data, dict):
+        keyframes = [(int(frame), _parse_corners(corners)) for frame, corners in data.items()]
+    elif isinstance(data, list) and data and all(isinstance(item, dict) for item in data):
+        keyframes = [(int(item["frame"]), _parse_corners(item["corners"])) for item in data]
+    elif isinstance(data, list) and data:
+        keyframes = [(frame, _parse_corners(corners)) for frame, corners in enumerate(data)]
+    else:
+        raise ValueError("corner_track 为空或格式不支持")
+
+    keyframes.sort(key=lambda item: item[0])
+    frames = np.array([frame for frame, _ in keyframes], dtype=np.float64)
+    corners = np.stack([c for _, c in keyframes]).reshape(len(keyframes), 8)
+
+    # np.interp 在区间外取端点值，正好对应首尾保持
+    targets = np.arange(frame_count, dtype=np.float64)
+    track_points = np.stack([np.interp(targets, frames, corners[:, k]) for k in range(8)], axis=1)
+    return track_points.reshape(frame_count, 4, 2)
 
 
 NODE_CLASS_MAPPINGS = {
@@ -0,0 +1,64 @@
+import os
+from collections import OrderedDict
+from PIL import Image
+from .image_utils import tensor_to_pil, pil_to_tensor, tensor_fingerprint
+
+
+# 预览图的最大边长（可用环境变量 BB_PREVIEW_MAX_SIZE 调整）
+PREVIEW_MAX_SIZE = int(os.environ.get("BB_PREVIEW_MAX_SIZE", 512))
+
+# 剪裁区域外遮罩的不透明度（0-255）
+PREVIEW_SHADE_ALPHA = 120
+
+# 预览代理图缓存的容量（按输入内容指纹）
+PROXY_CACHE_SIZE = 16
+
+_proxy_cache = OrderedDict()
+
+
+def get_preview_proxy(images, max_size=PREVIEW_MAX_SIZE):
+    """
+    返回第一帧缩小到 max_size 以内的代理图 [1, h, w, 3]
+    每个输入图像只缩放一次，之后按内容指纹直接复用
+    """
+    # 单帧输入直接对原 tensor 取指纹（可复用已记录的指纹），多帧时只取第一帧
+    key = (tensor_fingerprint(images if images.shape[0] == 1 else images[:1]), max_size)
+    proxy = _proxy_cache.get(key)
+    if proxy is not None:
+        _proxy_cache.move_to_end(key)
+        return proxy
+
+    pil_image = tensor_to_pil(images[0])
+    pil_image.thumbnail((min(max_size, pil_image.width), min(max_size, pil_image.height)), Image.Resampling.LANCZOS)
+    proxy = pil_to_tensor(pil_image)
+
+    _proxy_cache[key] = proxy
+    while len(_proxy_cache) > PROXY_CACHE_SIZE:
+        _proxy_cache.popitem(last=False)
+    return proxy
+
+
+def preview_canvas(images, max_size=PREVIEW_MAX_SIZE):
+    """
+    返回用于绘制预览叠加层的 RGB PIL 图像及其相对原图的缩放比例
+    画布来自缓存的代理图，原图坐标乘以该比例即为预览坐标
+    """
+    proxy = tensor_to_pil(get_preview_proxy(images, max_size)[0])
+    if proxy.mode != 'RGB':
+        proxy = proxy.convert('RGB')
+    return proxy, proxy.width / images.shape[2]
+
+
+def shade_outside(image, box, alpha=PREVIEW_SHADE_ALPHA):
+    """
+    将 box 之外的区域压暗，等价于叠加不透明度为 alpha 的黑色遮罩
+    直接对像素查表，不需要整图 RGBA 合成与模式转换
+    """
+    left, top, right, bottom = (int(round(v)) for v in box)
+    keep = 255 - alpha
+    shaded = image.point([(v * keep + 127) // 255 for v in range(256)] * len(image.getbands()))
+    left, top = max(0, left), max(0, top)
+    right, bottom = min(image.width, right + 1), min(image.height, bottom + 1)
+    if right > left and bottom > top:
+        shaded.paste(image.crop((left, top, right, bottom)), (left, top))
+    return shaded
@@ -0,0 +1,196 @@
+import torch
+import torch.nn.functional as F
+import numpy as np
+from .image_utils import gray_proxy
+
+
+# 四边形检测使用的代理图长边（像素）
+QUAD_PROXY_SIZE = 512
+
+# 置信度（检测四边形与前景掩码的 IoU）低于该值时视为检测失败
+QUAD_MIN_CONFIDENCE = 0.9
+
+# 前景面积占整图的比例范围（过小的多半是噪点或局部物体；几乎占满整图时没有可检测的边缘）
+QUAD_MIN_AREA = 0.05
+QUAD_MAX_AREA = 0.98
+
+# 拟合边线时，边界点到初始边的最大距离（代理图长边的比例）
+_EDGE_TOLERANCE = 0.03
+
+
+def _otsu_threshold(gray):
+    """Otsu 阈值：使前景/背景两类方差之和最小（256 级直方图，向量化计算）"""
+    histogram = torch.histc(gray, bins=256, min=0.0, max=1.0).double()
+    levels = (torch.arange(256, dtype=torch.float64) + 0.5) / 256.0
+    weight = torch.cumsum(histogram, 0)
+    mean = torch.cumsum(histogram * levels, 0)
+    total, total_mean = weight[-1], mean[-1]
+    background = weight
+    foreground = total - weight
+    between = (total_mean * background - mean * total) ** 2 / (background * foreground).clamp_min(1e-12)
+    return float(levels[int(torch.argmax(between[:-1]))] + 0.5 / 256.0)
+
+
+def _dilate(mask, size):
+    return F.max_pool2d(mask, size, stride=1, padding=size // 2)
+
+
+def _erode(mask, size):
+    return -F.max_pool2d(-mask, size, stride=1, padding=size // 2)
+
+
+def _document_mask(gray):
+    """
+    前景（文档）掩码 [h, w] bool：Otsu 二值化后取与图像边框接触较少的一类，
+    闭运算填平文字造成的空洞，开运算去掉背景中的小斑点
+    """
+    gray = F.avg_pool2d(F.pad(gray, (1, 1, 1, 1), mode="replicate"), 3, stride=1)
+    mask = (gray > _otsu_threshold(gray)).float()
+    border = torch.cat([mask[0, 0, 0], mask[0, 0, -1], mask[0, 0, :, 0], mask[0, 0, :, -1]])
+    if border.mean() > 0.5:
+        mask = 1.0 - mask
+
+    size = max(3, (max(mask.shape[-2:]) // 64) | 1)
+    mask = _erode(_dilate(mask, size), size)
+    mask = _dilate(_erode(mask, size), size)
+    return mask[0, 0] > 0.5
+
+
+def _extreme_corners(xs, ys):
+    """前景点在 x+y、x-y 方向上的极值点作为初始角点（左上、右上、右下、左下）"""
+    total, diff = xs + ys, xs - ys
+    indices = [torch.argmin(total), torch.argmax(diff), torch.argmax(total), torch.argmin(diff)]
+    return np.array([[xs[i].item(), ys[i].item()] for i in indices], dtype=np.float64)
+
+
+def _fit_edges(corners, xs, ys, tolerance):
+    """
+    用掩码边界点对四条边做整体最小二乘直线拟合，相邻边线求交得到亚像素角点
+    边界点按到初始四条边的距离归属（只用每条边中间 80% 的点，避开圆角）；点数不足的边保留初始边
+    """
+    center = corners.mean(axis=0)
+    lines = []
+    for k in range(4):
+        start, end = corners[k], corners[(k + 1) % 4]
+        direction = end - start
+        length = np.hypot(*direction)
+        if length < 1e-6:
+            return corners
+        direction = direction / length
+        normal = np.array([-direction[1], direction[0]])
+        rel_x, rel_y = xs - start[0], ys - start[1]
+        along = (rel_x * direction[0] + rel_y * direction[1]) / length
+        across = rel_x * normal[0] + rel_y * normal[1]
+        chosen = (np.abs(across) < tolerance) & (along > 0.1) & (along < 0.9)
+
+        point, line_dir = start, direction
+        if chosen.sum() >= 10:
+            px, py = xs[chosen], ys[chosen]
+            point = np.array([px.mean(), py.mean()])
+            covariance = np.cov(np.stack([px - point[0], py - point[1]]))
+            line_dir = np.linalg.eigh(covariance)[1][:, -1]
+            # 边界点是最外一圈前景像素的中心，真实边缘在其外侧半个像素
+            line_normal = np.array([-line_dir[1], line_dir[0]])
+            if np.dot(point - center, line_normal) < 0:
+                line_normal = -line_normal
+            point = point + 0.5 * line_normal
+        lines.append((point, line_dir))
+
+    refined = corners.copy()
+    for k in range(4):
+        (p1, d1), (p2, d2) = lines[k - 1], lines[k]
+        system = np.array([[d1[0], -d2[0]], [d1[1], -d2[1]]])
+        if abs(np.linalg.det(system)) < 1e-6:
+            continue
+        t = np.linalg.solve(system, p2 - p1)
+        refined[k] = p1 + t[0] * d1
+    return refined
+
+
+def _quad_iou(corners, mask):
+    """四边形（凸）与掩码的 IoU；四边形非凸或退化时返回 0"""
+    height, width = mask.shape
+    ys = torch.arange(height, dtype=torch.float64)[:, None] + 0.5
+    xs = torch.arange(width, dtype=torch.float64)[None, :] + 0.5
+
+    crosses = []
+    for k in range(4):
+        (x0, y0), (x1, y1) = corners[k], corners[(k + 1) % 4]
+        crosses.append((x1 - x0) * (ys - y0) - (y1 - y0) * (xs - x0))
+    # 凸性：相邻边叉积（z 分量）同号
+    turns = []
+    for k in range(4):
+        (ax, ay), (bx, by) = corners[(k + 1) % 4] - corners[k], corners[(k + 2) % 4] - corners[(k + 1) % 4]
+        turns.append(ax * by - ay * bx)
+    if not (all(t > 0 for t in turns) or all(t < 0 for t in turns)):
+        return 0.0
+    sign = 1.0 if turns[0] > 0 else -1.0
+    inside = torch.ones((height, width), dtype=torch.bool)
+    for cross in crosses:
+        inside &= cross * sign >= 0
+
+    union = (inside | mask).sum().item()
+    return (inside & mask).sum().item() / union if union else 0.0
+
+
+def _edge_contrast(corners, gray, mask):
+    """
+    四条边的边缘对比度：沿每条边在内外两侧各偏移 2 个像素采样灰度差，取最弱一条边，
+    除以前景/背景的平均灰度差（清晰的真实边缘约为 1，渐变或噪声中的阈值分界接近 0）
+    """
+    separation = abs(gray[0, 0][mask].mean().item() - gray[0, 0][~mask].mean().item())
+    if separation < 1e-3:
+        return 0.0
+
+    height, width = mask.shape
+    center = corners.mean(axis=0)
+    t = np.linspace(0.1, 0.9, 64)[:, None]
+    weakest = np.inf
+    for k in range(4):
+        start, end = corners[k], corners[(k + 1) % 4]
+        direction = (end - start) / max(np.hypot(*(end - start)), 1e-6)
+        normal = np.array([-direction[1], direction[0]])
+        if np.dot((start + end) / 2 - center, normal) < 0:
+            normal = -normal
+        points = start + t * (end - start)
+        samples = np.concatenate([points - 2.0 * normal, points + 2.0 * normal])
+        # 像素坐标 -> grid_sample 归一化坐标（align_corners=False）
+        grid = torch.from_numpy(samples * 2.0 / np.array([width, height]) - 1.0).float()[None, None]
+        values = F.grid_sample(gray, grid, mode="bilinear", padding_mode="border", align_corners=False)[0, 0, 0]
+        inner, outer = values[:len(t)], values[len(t):]
+        weakest = min(weakest, (inner - outer).abs().mean().item())
+    return weakest / separation
+
+
+def detect_document_quad(frame):
+    """
+    在单帧 [H, W, C] 中检测主导的文档四边形
+    返回 (corners, confidence)：corners 为原图坐标的 [4, 2] 数组（左上、右上、右下、左下），
+    confidence 为四边形与前景掩码的 IoU 乘以边缘对比度（均为 0-1）；没有找到前景时 corners 为 None
+    流程（缩小的代理图上）：Otsu 前景掩码 -> 极值点初始角点 -> 边界点直线拟合求交 -> 置信度
+    """
+    height, width = frame.shape[0], frame.shape[1]
+    gray = gray_proxy(frame, QUAD_PROXY_SIZE)
+    proxy_height, proxy_width = gray.shape[-2:]
+    if proxy_width < 8 or proxy_height < 8:
+        return None, 0.0
+
+    mask = _document_mask(gray)
+    area = mask.sum().item()
+    if not QUAD_MIN_AREA * mask.numel() <= area <= QUAD_MAX_AREA * mask.numel():
+        return None, 0.0
+
+    ys, xs = torch.nonzero(mask, as_tuple=True)
+    corners = _extreme_corners(xs.double() + 0.5, ys.double() + 0.5)
+
+    boundary = mask & ~(_erode(mask[None, None].float(), 3)[0, 0] > 0.5)
+    by, bx = torch.nonzero(boundary, as_tuple=True)
+    corners = _fit_edges(corners, bx.double().numpy() + 0.5, by.double().numpy() + 0.5,
+                         _EDGE_TOLERANCE * max(proxy_width, proxy_height))
+
+    confidence = _quad_iou(corners, mask)
+    if confidence > 0:
+        confidence *= min(1.0, _edge_contrast(corners, gray, mask))
+    # 代理图坐标 -> 原图坐标
+    corners = corners * np.array([width / proxy_width, height / proxy_height])
+    return corners, confidence
@@ -1,6 +1,8 @@
 import torch
-import numpy as np
-from PIL import Image, ImageDraw
+from PIL import ImageDraw
+from .image_utils import pil_to_tensor, as_batch
+from .preview_utils import preview_canvas, shade_outside
+from .result_cache import cached_result, inputs_fingerprint
 
 class RatioCropWithPanel:
     """
@@ -64,18 +66,19 @@ class RatioCropWithPanel:
     FUNCTION = "crop_image"
     CATEGORY = "🔵BB image crop"
     
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        """控件值的指纹（ComfyUI 调用时只传入控件值，不含连线输入；连线输入是否变化由 ComfyUI 按上游节点判断）"""
+        return inputs_fingerprint(kwargs)
+    
+    @cached_result(disk=True)
     def crop_image(self, image, aspect_ratio, crop_size, crop_x=0, crop_y=0, crop_scale=1.0):
         """
         执行图像剪裁并生成预览
         图像固定，只移动和缩放裁剪框
         """
-        # 转换tensor到PIL图像
-        if len(image.shape) == 4:
-            pil_image = self.tensor_to_pil(image[0])
-        else:
-            pil_image = self.tensor_to_pil(image)
-        
-        img_width, img_height = pil_image.size
+        batch = as_batch(image)
+        img_height, img_width = batch.shape[1], batch.shape[2]
         
         # 计算裁剪框尺寸（根据比例和缩放）
         if aspect_ratio == "自定义":
@@ -99,24 +102,26 @@ class RatioCropWithPanel:
         start_x = (img_width - crop_width) // 2 + crop_x
         start_y = (img_height - crop_height) // 2 + crop_y
         
-        # 执行剪裁
-        cropped_image = self.perform_crop(pil_image, start_x, start_y, crop_width, crop_height)
-        
-        # 生成预览图像（显示剪裁区域）
-        preview_image = self.create_preview(pil_image, start_x, start_y, crop_width, crop_height)
+        # 执行剪裁（整个批次一次切片完成）
+        cropped_tensor = self.perform_crop(batch, start_x, start_y, crop_width, crop_height)
         
-        # 转换回tensor
-        cropped_tensor = self.pil_to_tensor(cropped_image)
-        preview_tensor = self.pil_to_tensor(preview_image)
+        # 生成预览图像（在缩小的代理图上显示第一帧的剪裁区域）
+        preview, factor = preview_canvas(batch)
+        preview_image = self.create_preview(preview, start_x * factor, start_y * factor,
+                                            crop_width * factor, crop_height * factor)
+        preview_tensor = pil_to_tensor(preview_image)
         
         return (cropped_tensor, preview_tensor)
     
-    def perform_crop(self, image, start_x, start_y, crop_width, crop_height):
-        """执行实际的剪裁操作"""
-        img_width, img_height = image.size
+    def perform_crop(self, images, start_x, start_y, crop_width, crop_height):
+        """执行实际的剪裁操作（对 [B, H, W, C] 批次直接切片，超出部分填充黑色）"""
+        batch_size, img_height, img_width, channels = images.shape
+        if channels == 1:
+            images = images.expand(-1, -1, -1, 3)
+            channels = 3
         
         # 创建目标尺寸的画布
-        result = Image.new('RGB', (crop_width, crop_height), (0, 0, 0))
+        result = torch.zeros((batch_size, crop_height, crop_width, channels), dtype=torch.float32)
         
         # 计算可见区域
         visible_start_x = max(0, -start_x)
@@ -125,18 +130,14 @@ class RatioCropWithPanel:
         visible_end_y = min(crop_height, img_height - start_y)
         
         if visible_end_x > visible_start_x and visible_end_y > visible_start_y:
-            # 从原图剪裁可见部分
+            # 从原图剪裁可见部分并写入画布
             crop_from_x = max(0, start_x)
             crop_from_y = max(0, start_y)
             crop_to_x = min(img_width, start_x + crop_width)
             crop_to_y = min(img_height, start_y + crop_height)
             
-            cropped_part = image.crop((crop_from_x, crop_from_y, crop_to_x, crop_to_y))
-            
-            # 粘贴到结果图像
-            paste_x = max(0, -start_x)
-            paste_y = max(0, -start_y)
-            result.paste(cropped_part, (paste_x, paste_y))
+            result[:, visible_start_y:visible_end_y, visible_start_x:visible_end_x, :] = \
+                images[:, crop_from_y:crop_to_y, crop_from_x:crop_to_x, :].clamp(0, 1)
         
         return result
     
@@ -183,65 +184,6 @@ class RatioCropWithPanel:
                   fill=(0, 255, 0), width=3)
         
         # 半透明遮罩（剪裁区域外）
-        mask = Image.new('RGBA', preview.size, (0, 0, 0, 120))
-        mask_draw = ImageDraw.Draw(mask)
-        
-        # 清除剪裁区域的遮罩
-        mask_draw.rectangle([start_x, start_y, end_x, end_y], fill=(0, 0, 0, 0))
-        
-        # 应用遮罩
-        preview = preview.convert('RGBA')
-        preview = Image.alpha_composite(preview, mask)
-        preview = preview.convert('RGB')
+        preview = shade_outside(preview, (start_x, start_y, end_x, end_y))
         
         return preview
-    
-    def tensor_to_pil(self, tensor):
-        """将tensor转换为PIL图像"""
-        # tensor shape: [H, W, C] 或 [C, H, W]
-        if len(tensor.shape) == 3:
-            if tensor.shape[0] == 3 or tensor.shape[0] == 1:  # [C, H, W]
-                tensor = tensor.permute(1, 2, 0)  # 转换为 [H, W, C]
-        
-        # 确保值在0-1范围内
-        tensor = torch.clamp(tensor, 0, 1)
-        
-        # 转换为numpy数组
-        numpy_image = tensor.cpu().numpy()
-        
-        # 转换为0-255范围
-        numpy_image = (numpy_image * 255).astype(np.uint8)
-        
-        # 转换为PIL图像
-        if len(numpy_image.shape) == 2:
-            # 灰度图像
-            pil_image = Image.fromarray(numpy_image, mode='L').convert('RGB')
-        elif numpy_image.shape[2] == 1:
-            # 单通道图像
-            pil_image = Image.fromarray(numpy_image.squeeze(), mode='L').convert('RGB')
-        else:
-            # RGB图像
-            pil_image = Image.fromarray(numpy_image, mode='RGB')
-        
-        return pil_image
-    
-    def pil_to_tensor(self, pil_image):
-        """将PIL图像转换为tensor"""
-        # 确保是RGB模式
-        if pil_image.mode != 'RGB':
-            pil_image = pil_image.convert('RGB')
-        
-        # 转换为numpy数组
-        numpy_image = np.array(pil_image).astype(np.float32)
-        
-        # 归一化到0-1范围
-        numpy_image = numpy_image / 255.0
-        
-        # 转换为tensor [H, W, C]
-        tensor = torch.from_numpy(numpy_image)
-        
-        # 添加批次维度 [1, H, W, C]
-        tensor = tensor.unsqueeze(0)
-        
-        return tensor
-
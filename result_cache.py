@@ -0,0 +1,335 @@
+import os
+import json
+import time
+import uuid
+import hashlib
+import inspect
+import functools
+import threading
+from collections import OrderedDict
+import torch
+import numpy as np
+from PIL import Image
+from .image_utils import tensor_content_hash, fingerprint_scope, uint8_to_tensor
+
+
+# 进程内结果缓存的容量上限（MB，可用环境变量 BB_RESULT_CACHE_MB 调整，0 表示关闭）
+RESULT_CACHE_MB = int(os.environ.get("BB_RESULT_CACHE_MB", 1024))
+
+# 磁盘结果缓存目录（环境变量 BB_DISK_CACHE_DIR，未设置时不启用）与容量上限（MB）
+DISK_CACHE_DIR = os.environ.get("BB_DISK_CACHE_DIR", "")
+DISK_CACHE_MB = int(os.environ.get("BB_DISK_CACHE_MB", 4096))
+
+# 没有描述文件的数组文件（写入中途进程退出的残留）超过该秒数后在淘汰时删除
+DISK_ORPHAN_SECONDS = 60
+
+
+def value_fingerprint(value):
+    """
+    单个输入值的指纹：tensor / 数组用完整内容哈希，带 fingerprint() 方法的对象（如 ColorLUT）用其自身指纹，
+    其余（数字、字符串、布尔等控件值）直接用 repr
+    """
+    if isinstance(value, torch.Tensor):
+        return "tensor:" + tensor_content_hash(value)
+    if isinstance(value, np.ndarray):
+        digest = hashlib.blake2b(repr((value.shape, str(value.dtype))).encode(), digest_size=16)
+        digest.update(memoryview(np.ascontiguousarray(value)).cast("B"))
+        return "ndarray:" + digest.hexdigest()
+    if hasattr(value, "fingerprint"):
+        return type(value).__name__ + ":" + value.fingerprint()
+    return repr(value)
+
+
+def inputs_fingerprint(inputs):
+    """一组节点输入（名称 -> 值）的指纹"""
+    digest = hashlib.blake2b(digest_size=16)
+    for name in sorted(inputs):
+        digest.update(f"{name}={value_fingerprint(inputs[name])};".encode())
+    return digest.hexdigest()
+
+
+def result_nbytes(value):
+    """估算缓存结果占用的字节数（只统计 tensor / 数组 / PIL 图像等大对象）"""
+    if isinstance(value, torch.Tensor):
+        return value.numel() * value.element_size()
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, Image.Image):
+        return value.width * value.height * len(value.getbands())
+    if isinstance(value, (tuple, list)):
+        return sum(result_nbytes(v) for v in value)
+    if hasattr(value, "tables"):
+        return result_nbytes(value.tables)
+    if isinstance(value, str):
+        return len(value)
+    return 0
+
+
+class ResultCache:
+    """
+    按字节预算淘汰的 LRU 结果缓存
+    键为 (节点类名, 输入指纹)，值为节点返回的元组
+    """
+
+    def __init__(self, max_bytes):
+        self.max_bytes = max_bytes
+        self.current_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[0]
+
+    def put(self, key, value):
+        size = result_nbytes(value)
+        with self._lock:
+            # 单个结果超过整个预算时不缓存
+            if size > self.max_bytes:
+                return
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.current_bytes -= old[1]
+            self._entries[key] = (value, size)
+            self.current_bytes += size
+            self._evict()
+
+    def _evict(self):
+        while self.current_bytes > self.max_bytes and self._entries:
+            _, (_, size) = self._entries.popitem(last=False)
+            self.current_bytes -= size
+            self.evictions += 1
+
+    def set_budget(self, max_bytes):
+        """调整字节预算（立即按新预算淘汰）"""
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.current_bytes = 0
+
+    def info(self):
+        """命中/未命中/淘汰次数与当前占用，用于监控"""
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+class DiskCache:
+    """
+    跨进程重启保留的磁盘结果缓存
+    - 每个结果存为一个 <key>.json 描述文件，IMAGE 输出按 uint8 存为 <key>_<i>.npy（读取时内存映射）
+      量化是有损的：put 返回量化后的结果，调用方应返回它，使首次计算与之后的内存/磁盘命中输出一致
+    - 命中时更新文件修改时间；总大小超过预算时按修改时间从旧到新删除（LRU）
+    - 只保存 tensor 与数字/字符串/布尔输出，其他类型的结果不落盘
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._current_bytes = None
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        return bool(self.directory) and self.max_bytes > 0
+
+    def _path(self, name):
+        return os.path.join(self.directory, name)
+
+    def _entry_files(self, key):
+        """某个键对应的全部文件（描述文件 + 数组文件）"""
+        meta_path = self._path(key + ".json")
+        with open(meta_path, "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        return meta, [meta_path] + [self._path(item["file"]) for item in meta if item["kind"] == "image"]
+
+    def get(self, key):
+        try:
+            meta, files = self._entry_files(key)
+            result = []
+            for item in meta:
+                if item["kind"] == "image":
+                    result.append(uint8_to_tensor(np.load(self._path(item["file"]), mmap_mode="r")))
+                else:
+                    result.append(item["value"])
+            for path in files:
+                os.utime(path)
+        except (OSError, ValueError, KeyError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return tuple(result)
+
+    def put(self, key, result):
+        """写入结果，返回与之后磁盘命中一致的（量化后的）结果；不支持的结果类型不落盘，原样返回"""
+        if not all(isinstance(v, (torch.Tensor, bool, int, float, str)) for v in result):
+            return result
+        os.makedirs(self.directory, exist_ok=True)
+
+        meta = []
+        stored = []
+        written = 0
+        for index, value in enumerate(result):
+            if isinstance(value, torch.Tensor):
+                array = value.detach().cpu().clamp(0, 1).mul(255.0).round_().to(torch.uint8).numpy()
+                name = f"{key}_{index}.npy"
+                written += self._atomic_write(name, lambda f, a=array: np.save(f, a))
+                meta.append({"kind": "image", "file": name})
+                stored.append(uint8_to_tensor(array))
+            else:
+                meta.append({"kind": "value", "value": value})
+                stored.append(value)
+        # 描述文件最后写入：存在描述文件即表示条目完整
+        written += self._atomic_write(key + ".json", lambda f: f.write(json.dumps(meta).encode("utf-8")))
+
+        with self._lock:
+            if self._current_bytes is not None:
+                self._current_bytes += written
+        self._evict()
+        return tuple(stored)
+
+    def _atomic_write(self, name, writer):
+        """先写临时文件再改名，避免并发读取到半个文件；返回写入的字节数"""
+        path = self._path(name)
+        temp_path = f"{path}.{uuid.uuid4().hex}.tmp"
+        with open(temp_path, "wb") as f:
+            writer(f)
+        os.replace(temp_path, path)
+        return os.path.getsize(path)
+
+    def _evict(self):
+        with self._lock:
+            if self._current_bytes is not None and self._current_bytes <= self.max_bytes:
+                return
+            entries = [entry for entry in os.scandir(self.directory)
+                       if entry.is_file() and entry.name.endswith((".json", ".npy"))]
+            keys = {entry.name[:-len(".json")] for entry in entries if entry.name.endswith(".json")}
+            orphan_deadline = time.time() - DISK_ORPHAN_SECONDS
+            files = []
+            for entry in entries:
+                stat = entry.stat()
+                # 数组文件名为 <key>_<i>.npy：没有对应描述文件的是残留（或正在写入），不计入总量，过期后删除
+                if entry.name.endswith(".npy") and entry.name.rsplit("_", 1)[0] not in keys:
+                    if stat.st_mtime < orphan_deadline:
+                        try:
+                            os.remove(entry.path)
+                        except OSError:
+                            pass
+                    continue
+                files.append((stat.st_mtime_ns, entry.name, stat.st_size))
+            total = sum(size for _, _, size in files)
+            # 以描述文件为单位淘汰最久未使用的条目
+            for _, name, _ in sorted(files):
+                if total <= self.max_bytes:
+                    break
+                if not name.endswith(".json"):
+                    continue
+                key = name[:-len(".json")]
+                try:
+                    _, entry_files = self._entry_files(key)
+                except (OSError, ValueError, KeyError):
+                    entry_files = [self._path(name)]
+                for path in entry_files:
+                    try:
+                        total -= os.path.getsize(path)
+                        os.remove(path)
+                    except OSError:
+                        pass
+                self.evictions += 1
+            self._current_bytes = total
+
+    def info(self):
+        with self._lock:
+            return {
+                "directory": self.directory,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+            }
+
+
+RESULT_CACHE = ResultCache(RESULT_CACHE_MB * 1024 * 1024)
+
+DISK_CACHE = DiskCache(DISK_CACHE_DIR, DISK_CACHE_MB * 1024 * 1024)
+
+
+def result_cache_info():
+    """节点结果缓存的统计信息（内存缓存，以及启用时的磁盘缓存）"""
+    info = RESULT_CACHE.info()
+    if DISK_CACHE.enabled:
+        info["disk"] = DISK_CACHE.info()
+    return info
+
+
+def cached_result(func=None, disk=False):
+    """
+    节点主函数的结果缓存装饰器
+    以 (节点类名, 全部输入的内容指纹) 为键；参数和输入内容都未变时直接返回上次的结果
+    整个调用在 fingerprint_scope 内执行：输入图像只做一次完整哈希，节点内部的源图缓存、预览代理直接复用
+    disk=True 时在内存未命中后再查磁盘缓存（需设置 BB_DISK_CACHE_DIR），适合开销大的几何变换
+    """
+    if func is None:
+        return functools.partial(cached_result, disk=disk)
+
+    signature = inspect.signature(func)
+
+    @functools.wraps(func)
+    def wrapper(self, *args, **kwargs):
+        with fingerprint_scope():
+            return lookup(self, *args, **kwargs)
+
+    def lookup(self, *args, **kwargs):
+        use_disk = disk and DISK_CACHE.enabled
+        if RESULT_CACHE.max_bytes <= 0 and not use_disk:
+            return func(self, *args, **kwargs)
+
+        bound = signature.bind(self, *args, **kwargs)
+        bound.apply_defaults()
+        inputs = dict(bound.arguments)
+        inputs.pop("self", None)
+
+        key = (type(self).__name__, inputs_fingerprint(inputs))
+
+        result = RESULT_CACHE.get(key)
+        if result is not None:
+            return result
+
+        disk_key = None
+        if use_disk:
+            disk_key = hashlib.blake2b(repr(key).encode(), digest_size=16).hexdigest()
+            result = DISK_CACHE.get(disk_key)
+
+        if result is None:
+            result = func(self, *args, **kwargs)
+            if disk_key is not None:
+                result = DISK_CACHE.put(disk_key, result)
+        RESULT_CACHE.put(key, result)
+        return result
+
+    return wrapper
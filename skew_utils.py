@@ -0,0 +1,147 @@
+import math
+import torch
+import torch.nn.functional as F
+from .image_utils import gray_proxy
+
+
+# 角度估计使用的代理图长边（像素）
+SKEW_PROXY_SIZE = 1024
+
+# 方向直方图的分辨率（度/格）与平滑核宽度（度）
+SKEW_BIN_DEGREES = 0.05
+SKEW_SMOOTH_DEGREES = 0.3
+
+# 参与投票的像素：梯度幅值最大的这一比例（纹理/噪声区域的弱梯度不参与）
+SKEW_EDGE_FRACTION = 0.1
+
+# 峰值不明显（峰值 / 平均值 低于该比例）时认为没有主导方向，返回 0
+SKEW_MIN_PEAK_RATIO = 2.0
+
+# 投影细化：先在粗估角度附近 ±SKEW_SEARCH_RANGE 度内按 SKEW_SEARCH_STEP 度搜索（覆盖方向直方图粗估的偏差，
+# 文字等内容的粗估可偏离 2-3°），再在其附近 ±SKEW_REFINE_RANGE 度内按 SKEW_REFINE_STEP 度细化
+# 最优值落在窗口边缘（或相邻一格）时说明峰值在窗口外，以最优值为中心重新搜索，最多 SKEW_REFINE_MAX_SHIFTS 次
+SKEW_SEARCH_RANGE = 3.0
+SKEW_SEARCH_STEP = 0.1
+SKEW_REFINE_RANGE = 0.2
+SKEW_REFINE_STEP = 0.05
+SKEW_REFINE_MAX_SHIFTS = 8
+
+# Scharr 算子（方向估计比 Sobel 更各向同性）
+_SCHARR_X = torch.tensor([[-3.0, 0.0, 3.0], [-10.0, 0.0, 10.0], [-3.0, 0.0, 3.0]])
+
+
+def _edge_points(gray):
+    """
+    梯度最强的边缘像素：返回 (x, y, 方向角度 模 90°, 权重)，均为一维 tensor；没有边缘时返回 None
+    先做轻度高斯平滑，减小像素栅格对方向估计的偏差
+    """
+    taps = torch.arange(-3, 4, dtype=torch.float32)
+    gauss = torch.exp(-0.5 * (taps / 1.2) ** 2)
+    gauss /= gauss.sum()
+    gray = F.conv2d(F.conv2d(gray, gauss.view(1, 1, 1, 7)), gauss.view(1, 1, 7, 1))
+    if gray.shape[-1] < 3 or gray.shape[-2] < 3:
+        return None
+
+    gradients = F.conv2d(gray, torch.stack([_SCHARR_X, _SCHARR_X.t()])[:, None])[0]
+    height, width = gradients.shape[1:]
+    gx, gy = gradients[0].flatten(), gradients[1].flatten()
+    magnitude = torch.hypot(gx, gy)
+
+    count = magnitude.numel()
+    keep = max(1, int(count * SKEW_EDGE_FRACTION))
+    threshold = torch.kthvalue(magnitude, count - keep + 1).values.item()
+    index = torch.nonzero(magnitude >= max(threshold, 1e-6)).flatten()
+    if index.numel() == 0:
+        return None
+
+    # 线条方向与梯度方向相差 90°，模 90° 后相同
+    orientation = torch.rad2deg(torch.atan2(gy[index], gx[index])).remainder(90.0)
+    return (index % width).double(), (index // width).double(), orientation, magnitude[index].double()
+
+
+def _orientation_peak(orientation, weights):
+    """方向直方图（模 90°，循环平滑）的峰值角度；没有明显主导方向时返回 None"""
+    bins = int(round(90.0 / SKEW_BIN_DEGREES))
+    index = (orientation / SKEW_BIN_DEGREES).long().clamp_(0, bins - 1)
+    histogram = torch.bincount(index, weights=weights, minlength=bins)
+
+    sigma = SKEW_SMOOTH_DEGREES / SKEW_BIN_DEGREES
+    radius = int(math.ceil(3 * sigma))
+    offsets = torch.arange(-radius, radius + 1, dtype=torch.float64)
+    kernel = torch.exp(-0.5 * (offsets / sigma) ** 2)
+    padded = torch.cat([histogram[-radius:], histogram, histogram[:radius]])
+    smoothed = F.conv1d(padded[None, None], (kernel / kernel.sum())[None, None])[0, 0]
+
+    peak = int(torch.argmax(smoothed))
+    if smoothed[peak] < SKEW_MIN_PEAK_RATIO * smoothed.mean():
+        return None
+    return (peak + 0.5) * SKEW_BIN_DEGREES
+
+
+def _parabolic_offset(left, center, right):
+    """三点抛物线插值的峰值偏移（单位：格）"""
+    denom = left - 2.0 * center + right
+    return float(0.5 * (left - right) / denom) if denom < 0 else 0.0
+
+
+def _projection_scores(x, y, weights, candidates):
+    """各候选角度下边缘点沿该方向（及其垂直方向）的投影直方图平方和，所有候选角度一次向量化计算"""
+    theta = torch.deg2rad(candidates)[:, None]
+    sin_t, cos_t = torch.sin(theta), torch.cos(theta)
+
+    scores = torch.zeros(len(candidates), dtype=torch.float64)
+    for offset in (-sin_t * x + cos_t * y, cos_t * x + sin_t * y):
+        # 每个候选角度占用独立的一段直方图
+        offset = torch.floor(offset - offset.min(dim=1, keepdim=True).values).long()
+        span = int(offset.max()) + 1
+        flat = offset + span * torch.arange(len(candidates))[:, None]
+        histogram = torch.bincount(flat.flatten(), weights=weights.expand(len(candidates), -1).flatten(),
+                                   minlength=span * len(candidates))
+        scores += (histogram.view(len(candidates), span) ** 2).sum(dim=1)
+    return scores
+
+
+def _refine_by_projection(x, y, weights, angle):
+    """在粗估角度附近搜索，使边缘点的投影直方图最集中（平方和最大）：先大范围粗搜，再小范围细化"""
+    angle = _search_projection(x, y, weights, angle, SKEW_SEARCH_RANGE, SKEW_SEARCH_STEP)
+    return _search_projection(x, y, weights, angle, SKEW_REFINE_RANGE, SKEW_REFINE_STEP)
+
+
+def _search_projection(x, y, weights, angle, search_range, step):
+    """
+    在 angle ± search_range 内按 step 搜索投影集中度的峰值（抛物线插值到格内）
+    窗口内的最优值不是内部峰值时平移窗口继续搜索
+    """
+    steps = int(round(search_range / step))
+    offsets = step * torch.arange(-steps, steps + 1, dtype=torch.float64)
+    for _ in range(SKEW_REFINE_MAX_SHIFTS + 1):
+        candidates = angle + offsets
+        scores = _projection_scores(x, y, weights, candidates)
+        best = int(torch.argmax(scores))
+        if 1 < best < len(candidates) - 2:
+            break
+        angle = float(candidates[best])
+
+    if 0 < best < len(candidates) - 1:
+        return float(candidates[best]) + step * _parabolic_offset(*scores[best - 1:best + 2])
+    return float(candidates[best])
+
+
+def estimate_skew_angle(frame):
+    """
+    估计单帧 [H, W, C] 的主导倾斜角（度，范围 [-45, 45)），与参考线角度同号：
+    把返回值作为 rotation_angle 旋转后，主导的近水平/近竖直线条变为水平/竖直；没有明显方向时返回 0
+    在缩小的灰度代理图上：梯度方向直方图（按幅值加权、模 90°）给出粗估，
+    再在其附近用边缘点的投影集中度细化到约 0.05° 以内
+    """
+    points = _edge_points(gray_proxy(frame, SKEW_PROXY_SIZE))
+    if points is None:
+        return 0.0
+    x, y, orientation, weights = points
+
+    coarse = _orientation_peak(orientation, weights)
+    if coarse is None:
+        return 0.0
+    angle = _refine_by_projection(x, y, weights, coarse)
+    # 映射到 [-45, 45)
+    return (angle + 45.0) % 90.0 - 45.0
@@ -1,7 +1,14 @@
-import torch
 import numpy as np
 from PIL import Image, ImageDraw, ImageFont
 import math
+import json
+from .image_utils import tensor_to_pil, pil_to_tensor, as_batch, pil_list_to_tensor
+from .preview_utils import preview_canvas
+from .result_cache import cached_result, inputs_fingerprint
+from .parallel_utils import parallel_map
+from .skew_utils import estimate_skew_angle
+from .interactive_crop_with_panel import rotation_matrix
+from .warp_utils import warp_perspective_sequence
 
 class StraightenLayerWithPanel:
     """
@@ -56,6 +63,18 @@ class StraightenLayerWithPanel:
                 "fill_color": (["black", "white", "transparent"], {
                     "default": "black"
                 }),
+            },
+            "optional": {
+                # manual：使用 rotation_angle / 参考线；auto：逐帧自动检测主导倾斜角（无人值守批量矫正）
+                "angle_mode": (["manual", "auto"], {
+                    "default": "manual"
+                }),
+                # 逐帧角度（视频防抖等）：列表 [a0, a1, ...] 或 "a0, a1, ..."（帧数不足时最后一个保持），
+                # 或关键帧 {"帧号": 角度}（关键帧之间线性插值）；填写后优先于 angle_mode
+                "frame_angles": ("STRING", {
+                    "default": "",
+                    "multiline": True
+                }),
             }
         }
     
@@ -64,14 +83,15 @@ class StraightenLayerWithPanel:
     FUNCTION = "straighten_layer"
     CATEGORY = "🔵BB image crop"
     
+    @classmethod
+    def IS_CHANGED(cls, **kwargs):
+        """控件值的指纹（ComfyUI 调用时只传入控件值，不含连线输入；连线输入是否变化由 ComfyUI 按上游节点判断）"""
+        return inputs_fingerprint(kwargs)
+    
+    @cached_result(disk=True)
     def straighten_layer(self, image, rotation_angle, reference_line_x1, reference_line_y1, 
-                        reference_line_x2, reference_line_y2, auto_crop, fill_color):
-        
-        # 转换tensor到PIL图像
-        if len(image.shape) == 4:
-            pil_image = self.tensor_to_pil(image[0])
-        else:
-            pil_image = self.tensor_to_pil(image)
+                        reference_line_x2, reference_line_y2, auto_crop, fill_color, angle_mode="manual",
+                        frame_angles=""):
         
         # 计算角度
         calculated_angle = rotation_angle
@@ -85,83 +105,86 @@ class StraightenLayerWithPanel:
             if abs(dx) > 0.1 or abs(dy) > 0.1:
                 calculated_angle = math.degrees(math.atan2(dy, dx))
         
-        # 应用旋转拉直图像
-        if calculated_angle != 0.0:
-            # 确定填充颜色
-            if fill_color == "white":
-                fillcolor = (255, 255, 255)
-            elif fill_color == "transparent":
-                fillcolor = (0, 0, 0, 0)
-                pil_image = pil_image.convert('RGBA')
-            else:
-                fillcolor = (0, 0, 0)
-            
-            # 旋转图像
-            rotated_image = pil_image.rotate(
-                calculated_angle, 
-                expand=True, 
-                resample=Image.Resampling.BICUBIC,
-                fillcolor=fillcolor
-            )
+        batch = as_batch(image)
+        
+        track = parse_frame_angles(frame_angles, batch.shape[0])
+        if track is not None:
+            angles = track
+            calculated_angle = angles[0]
+        elif angle_mode == "auto":
+            # 逐帧检测倾斜角（缩小的代理图上计算）；calculated_angle 返回第一帧的角度
+            angles = parallel_map(estimate_skew_angle, batch)
+            calculated_angle = angles[0]
         else:
-            rotated_image = pil_image
+            angles = [calculated_angle] * batch.shape[0]
         
-        # 根据auto_crop决定是否裁剪
-        if auto_crop:
-            final_image = self.auto_crop_rotated_image(rotated_image, calculated_angle)
+        if len(set(angles)) > 1:
+            # 各帧角度不同：统一输出尺寸，整个批次一次向量化采样
+            straightened_tensor = self.straighten_batch(batch, angles, auto_crop, fill_color)
         else:
-            final_image = rotated_image
+            # 所有帧角度相同：逐帧处理整个批次（共享线程池并行）
+            final_frames = parallel_map(
+                lambda frame: self.straighten_frame(tensor_to_pil(frame), angles[0], auto_crop, fill_color),
+                batch
+            )
+            
+            # 转换回tensor
+            straightened_tensor = pil_list_to_tensor(final_frames)
         
-        # 生成预览图像
+        # 生成预览图像（在缩小的代理图上绘制第一帧的参考线）
+        preview, factor = preview_canvas(batch)
         preview_image = self.create_preview(
-            pil_image, 
+            preview, 
             reference_line_x1, reference_line_y1,
             reference_line_x2, reference_line_y2,
-            calculated_angle
+            calculated_angle, factor
         )
-        
-        # 转换回tensor
-        straightened_tensor = self.pil_to_tensor(final_image)
-        preview_tensor = self.pil_to_tensor(preview_image)
+        preview_tensor = pil_to_tensor(preview_image)
         
         return (straightened_tensor, preview_tensor, calculated_angle)
     
-    def auto_crop_rotated_image(self, image, angle):
-        """自动裁剪旋转后的图像"""
-        if angle == 0:
-            return image
-        
-        width, height = image.size
-        angle_rad = math.radians(abs(angle))
-        
-        if width <= 0 or height <= 0:
-            return image
-        
-        sin_a = abs(math.sin(angle_rad))
-        cos_a = abs(math.cos(angle_rad))
-        
-        if sin_a < 1e-10:
-            return image
+    def straighten_batch(self, images, angles, auto_crop, fill_color):
+        """
+        逐帧不同角度的旋转：所有帧的逆向矩阵一起构建，批量双三次采样，输出尺寸统一
+        自动裁剪时输出完全落在每一帧内，按边缘像素延伸采样，不会混入填充色
+        """
+        size = (images.shape[2], images.shape[1])
+        out_size = common_output_size(size, angles, auto_crop)
+        inverses = [pixel_center_matrix(centered_rotation_matrix(size, angle, out_size)) for angle in angles]
+        return warp_perspective_sequence(images, inverses, out_size[0], out_size[1], "bicubic", fill_color,
+                                         padding_mode="border" if auto_crop else "zeros")
+    
+    def straighten_frame(self, pil_image, angle, auto_crop, fill_color):
+        """对单帧应用旋转拉直和自动裁剪"""
+        if angle == 0.0:
+            return pil_image
         
-        if width < height:
-            new_width = width
-            new_height = (width * sin_a + width * cos_a) / (sin_a + cos_a)
+        # 确定填充颜色
+        if fill_color == "white":
+            fillcolor = (255, 255, 255)
+        elif fill_color == "transparent":
+            fillcolor = (0, 0, 0, 0)
+            pil_image = pil_image.convert('RGBA')
         else:
-            new_height = height
-            new_width = (height * sin_a + height * cos_a) / (sin_a + cos_a)
-        
-        new_width = min(new_width, width)
-        new_height = min(new_height, height)
+            fillcolor = (0, 0, 0)
         
-        left = (width - new_width) / 2
-        top = (height - new_height) / 2
-        right = left + new_width
-        bottom = top + new_height
+        if auto_crop:
+            # 只对最大内接矩形做一次采样，不分配、不填充扩展后的画布
+            size = inscribed_output_size(pil_image.size, angle)
+            matrix = centered_rotation_matrix(pil_image.size, angle, size)
+            return pil_image.transform(size, Image.Transform.AFFINE, matrix,
+                                       resample=Image.Resampling.BICUBIC, fillcolor=fillcolor)
         
-        return image.crop((int(left), int(top), int(right), int(bottom)))
+        # 保留全部：扩展画布容纳整张旋转后的图像
+        return pil_image.rotate(
+            angle, 
+            expand=True, 
+            resample=Image.Resampling.BICUBIC,
+            fillcolor=fillcolor
+        )
     
-    def create_preview(self, image, line_x1, line_y1, line_x2, line_y2, angle):
-        """创建预览图像"""
+    def create_preview(self, image, line_x1, line_y1, line_x2, line_y2, angle, factor=1.0):
+        """创建预览图像（factor 为预览画布相对原图的缩放比例，参考线坐标按原图给出）"""
         preview = image.copy().convert('RGB')
         draw = ImageDraw.Draw(preview)
         
@@ -169,10 +192,10 @@ class StraightenLayerWithPanel:
         
         # 绘制参考线
         if not (line_x1 == 0 and line_y1 == 0 and line_x2 == 100 and line_y2 == 0):
-            x1 = max(0, min(img_width, line_x1))
-            y1 = max(0, min(img_height, line_y1))
-            x2 = max(0, min(img_width, line_x2))
-            y2 = max(0, min(img_height, line_y2))
+            x1 = max(0, min(img_width, line_x1 * factor))
+            y1 = max(0, min(img_height, line_y1 * factor))
+            x2 = max(0, min(img_width, line_x2 * factor))
+            y2 = max(0, min(img_height, line_y2 * factor))
             
             draw.line([(x1, y1), (x2, y2)], fill=(0, 255, 255), width=3)
             
@@ -194,39 +217,118 @@ class StraightenLayerWithPanel:
         draw.text((20, 20), angle_text, fill=(255, 255, 0), font=font)
         
         return preview
-    
-    def tensor_to_pil(self, tensor):
-        """将tensor转换为PIL图像"""
-        if len(tensor.shape) == 3:
-            if tensor.shape[0] == 3 or tensor.shape[0] == 1:
-                tensor = tensor.permute(1, 2, 0)
-        
-        tensor = torch.clamp(tensor, 0, 1)
-        numpy_image = tensor.cpu().numpy()
-        numpy_image = (numpy_image * 255).astype(np.uint8)
-        
-        if len(numpy_image.shape) == 2:
-            pil_image = Image.fromarray(numpy_image, mode='L').convert('RGB')
-        elif numpy_image.shape[2] == 1:
-            pil_image = Image.fromarray(numpy_image.squeeze(), mode='L').convert('RGB')
-        else:
-            pil_image = Image.fromarray(numpy_image, mode='RGB')
-        
-        return pil_image
-    
-    def pil_to_tensor(self, pil_image):
-        """将PIL图像转换为tensor"""
-        if pil_image.mode == 'RGBA':
-            pass
-        elif pil_image.mode != 'RGB':
-            pil_image = pil_image.convert('RGB')
-        
-        numpy_image = np.array(pil_image).astype(np.float32)
-        numpy_image = numpy_image / 255.0
-        tensor = torch.from_numpy(numpy_image)
-        tensor = tensor.unsqueeze(0)
-        
-        return tensor
+
+def inscribed_rect_size(width, height, angle):
+    """
+    宽 width、高 height 的矩形旋转 angle 度后，其内部面积最大的轴对齐矩形的尺寸（解析解）
+    - 短边相对较短（或 45°）时，最大矩形由两条长边夹住，两个角点落在长边上
+    - 否则四个角点分别落在旋转矩形的四条边上，解二元线性方程组
+    """
+    if width <= 0 or height <= 0:
+        return 0.0, 0.0
+    angle_rad = math.radians(angle)
+    sin_a = abs(math.sin(angle_rad))
+    cos_a = abs(math.cos(angle_rad))
+    if sin_a < 1e-12 or cos_a < 1e-12:
+        # 0° / 180° 不变，90° / 270° 宽高互换
+        return (float(width), float(height)) if cos_a >= sin_a else (float(height), float(width))
+
+    width_is_longer = width >= height
+    long_side, short_side = (width, height) if width_is_longer else (height, width)
+    if short_side <= 2.0 * sin_a * cos_a * long_side or abs(sin_a - cos_a) < 1e-12:
+        half = 0.5 * short_side
+        return (half / sin_a, half / cos_a) if width_is_longer else (half / cos_a, half / sin_a)
+
+    cos_2a = cos_a * cos_a - sin_a * sin_a
+    return (width * cos_a - height * sin_a) / cos_2a, (height * cos_a - width * sin_a) / cos_2a
+
+
+def inscribed_output_size(size, angle):
+    """
+    旋转 angle 度后自动裁剪的输出尺寸（最大内接矩形）
+    内接矩形按原图像素中心围成的 (width - 1) x (height - 1) 区域计算，输出的每个像素中心都映射到
+    原图像素中心范围内，双三次采样只会取到原图像素（边缘复制），不会混入填充色
+    """
+    width, height = size
+    rect_width, rect_height = inscribed_rect_size(width - 1, height - 1, angle)
+    # 输出像素中心跨度为 (N - 1)，留出浮点误差余量
+    return (max(1, int(math.floor(rect_width - 1e-6)) + 1),
+            max(1, int(math.floor(rect_height - 1e-6)) + 1))
+
+
+def common_output_size(size, angles, auto_crop):
+    """
+    一个批次内各帧角度不同时的统一输出尺寸；所有帧角度相同时返回 None（按单帧规则输出）
+    自动裁剪取各帧内接矩形的最小宽高（居中后仍落在每一帧的内接矩形内），
+    保留全部取各帧扩展画布的最大宽高
+    """
+    if len(set(angles)) <= 1:
+        return None
+    if auto_crop:
+        sizes = [inscribed_output_size(size, angle) for angle in angles]
+        return min(w for w, _ in sizes), min(h for _, h in sizes)
+    sizes = [rotation_matrix(size, -angle)[1] if angle != 0.0 else size for angle in angles]
+    return max(w for w, _ in sizes), max(h for _, h in sizes)
+
+
+def centered_rotation_matrix(size, angle, out_size):
+    """
+    与 PIL Image.rotate(angle) 同向旋转、输出 out_size 且两者中心对齐的逆向仿射矩阵（输出坐标 -> 原图坐标）
+    """
+    width, height = size
+    out_width, out_height = out_size
+    # PIL 的 rotate(angle) 内部使用 -angle 构造逆向矩阵
+    angle_rad = -math.radians(angle)
+    cos_a = round(math.cos(angle_rad), 15)
+    sin_a = round(math.sin(angle_rad), 15)
+    offset_x, offset_y = out_width / 2.0, out_height / 2.0
+    return [
+        cos_a, sin_a, width / 2.0 - cos_a * offset_x - sin_a * offset_y,
+        -sin_a, cos_a, height / 2.0 + sin_a * offset_x - cos_a * offset_y,
+    ]
+
+
+def pixel_center_matrix(matrix):
+    """
+    PIL 仿射矩阵（连续坐标，像素中心在 +0.5）-> 3x3 单应矩阵（像素中心在整数坐标，warp_utils 的约定）
+    """
+    a, b, c, d, e, f = matrix
+    return np.array([
+        [a, b, c + 0.5 * (a + b) - 0.5],
+        [d, e, f + 0.5 * (d + e) - 0.5],
+        [0.0, 0.0, 1.0],
+    ], dtype=np.float64)
+
+
+def parse_frame_angles(text, frame_count):
+    """
+    解析逐帧角度，返回长度为 frame_count 的角度列表；空字符串返回 None
+    - 列表：JSON [a0, a1, ...] 或逗号/空白分隔的数字，帧数不足时最后一个角度保持
+    - 关键帧：JSON {"帧号": 角度}，关键帧之间线性插值，首尾之外保持端点值
+    """
+    if not isinstance(text, str) or not text.strip():
+        return None
+    stripped = text.strip()
+    if stripped.startswith(("[", "{")):
+        try:
+            data = json.loads(stripped)
+        except json.JSONDecodeError as e:
+            raise ValueError(f"frame_angles 不是合法的 JSON：{e}")
+    else:
+        data = [float(v) for v in stripped.replace(",", " ").split()]
+
+    if isinstance(data, dict):
+        keyframes = sorted((int(frame), float(angle)) for frame, angle in data.items())
+        if not keyframes:
+            return None
+        frames = [frame for frame, _ in keyframes]
+        values = [angle for _, angle in keyframes]
+        return [float(v) for v in np.interp(np.arange(frame_count), frames, values)]
+
+    values = [float(v) for v in data]
+    if not values:
+        return None
+    return [values[min(i, len(values) - 1)] for i in range(frame_count)]
 
 
 NODE_CLASS_MAPPINGS = {
@@ -0,0 +1,516 @@
+import os
+import math
+import torch
+import torch.nn.functional as F
+import numpy as np
+from .image_utils import tensor_content_hash
+from .result_cache import ResultCache
+
+
+# 支持的插值方式（grid_sample 的 mode）
+WARP_MODES = ["bilinear", "bicubic"]
+
+# 填充颜色（RGB，0-1）；transparent 输出带 alpha 通道
+FILL_COLORS = {
+    "black": (0.0, 0.0, 0.0),
+    "white": (1.0, 1.0, 1.0),
+    "transparent": (0.0, 0.0, 0.0),
+}
+
+
+# 分块透视变换的块边长（环境变量 BB_WARP_TILE）；输出超过 4 块的面积时按块生成，内存占用与输出尺寸无关
+WARP_TILE_SIZE = max(64, int(os.environ.get("BB_WARP_TILE", 1024)))
+
+# 抗锯齿 mipmap 金字塔的最大层数（每层边长减半）
+MIPMAP_MAX_LEVELS = 16
+
+# mipmap 金字塔缓存的容量上限（MB，环境变量 BB_PYRAMID_CACHE_MB，0 表示关闭）
+# 按输入内容指纹缓存，同一输入调整角点重新执行时不必重建；超过上限的批次（长视频等）不缓存
+PYRAMID_CACHE_MB = int(os.environ.get("BB_PYRAMID_CACHE_MB", 64))
+
+# 采样网格 / mipmap 层级缓存的容量上限（MB，环境变量 BB_GRID_CACHE_MB，0 表示关闭）
+# 每个网格为 输出宽 x 高 x 2 的 float32；角点不变、只有输入图像变化时复用，拖动角点产生的新网格按字节淘汰
+GRID_CACHE_MB = int(os.environ.get("BB_GRID_CACHE_MB", 64))
+
+# 批量构建采样网格时每块的输出像素数（限制 float64 中间结果的内存）
+_GRID_CHUNK = 1 << 22
+
+# 界外 / 无穷远点使用的像素坐标（远离图像，插值权重全部落在界外）
+_OUTSIDE = -1e6
+
+_pyramid_cache = ResultCache(PYRAMID_CACHE_MB * 1024 * 1024)
+
+_grid_cache = ResultCache(GRID_CACHE_MB * 1024 * 1024)
+
+
+def _normalize_points(points):
+    """
+    Hartley 归一化：平移到质心并缩放使平均距离为 sqrt(2)
+    points: [N, 4, 2]，返回 (归一化点, [N, 3, 3] 变换)
+    """
+    points = np.asarray(points, dtype=np.float64)
+    center = points.mean(axis=1, keepdims=True)
+    distance = np.sqrt(((points - center) ** 2).sum(axis=2)).mean(axis=1)
+    scale = np.where(distance > 1e-12, np.sqrt(2.0) / np.maximum(distance, 1e-12), 1.0)
+
+    transform = np.zeros((len(points), 3, 3), dtype=np.float64)
+    transform[:, 0, 0] = scale
+    transform[:, 1, 1] = scale
+    transform[:, 0, 2] = -scale * center[:, 0, 0]
+    transform[:, 1, 2] = -scale * center[:, 0, 1]
+    transform[:, 2, 2] = 1.0
+    return (points - center) * scale[:, None, None], transform
+
+
+def solve_homographies(src_points, dst_points):
+    """
+    批量求单应矩阵：src_points / dst_points 为 [N, 4, 2]（或 [4, 2]，对所有 N 共用）
+    两组点先做 Hartley 归一化，再批量直接解 8x8 线性方程组（不走法方程，条件数小）
+    返回 [N, 3, 3]（src -> dst，H[2,2] = 1）；任一组退化（三点共线）时抛出 ValueError
+    """
+    src_points = np.asarray(src_points, dtype=np.float64)
+    dst_points = np.asarray(dst_points, dtype=np.float64)
+    count = max(len(src_points) if src_points.ndim == 3 else 1, len(dst_points) if dst_points.ndim == 3 else 1)
+    src, src_t = _normalize_points(np.broadcast_to(src_points, (count, 4, 2)))
+    dst, dst_t = _normalize_points(np.broadcast_to(dst_points, (count, 4, 2)))
+
+    x, y = src[..., 0], src[..., 1]
+    u, v = dst[..., 0], dst[..., 1]
+    zeros, ones = np.zeros_like(x), np.ones_like(x)
+    # 每个点贡献两行：[x, y, 1, 0, 0, 0, -ux, -uy] 与 [0, 0, 0, x, y, 1, -vx, -vy]
+    rows_u = np.stack([x, y, ones, zeros, zeros, zeros, -u * x, -u * y], axis=-1)
+    rows_v = np.stack([zeros, zeros, zeros, x, y, ones, -v * x, -v * y], axis=-1)
+    A = np.stack([rows_u, rows_v], axis=2).reshape(count, 8, 8)
+    b = np.stack([u, v], axis=2).reshape(count, 8)
+
+    try:
+        h = np.linalg.solve(A, b[..., None])[..., 0]
+    except np.linalg.LinAlgError:
+        raise ValueError("透视角点退化（存在三点共线），无法求解单应矩阵")
+
+    normalized = np.concatenate([h, np.ones((count, 1))], axis=1).reshape(count, 3, 3)
+    matrices = np.linalg.inv(dst_t) @ normalized @ src_t
+    return matrices / matrices[:, 2:3, 2:3]
+
+
+def solve_homography(src_points, dst_points):
+    """
+    由四对对应点求单应矩阵 H（3x3，src -> dst，H[2,2] = 1）
+    四点共线等退化情况抛出 ValueError
+    """
+    return solve_homographies(np.asarray(src_points)[None], np.asarray(dst_points)[None])[0]
+
+
+def _grid_cache_key(matrix, width, height, source_size):
+    return (tuple(np.round(np.asarray(matrix, dtype=np.float64).ravel(), 12)), width, height, source_size)
+
+
+def _is_affine(inverses):
+    return bool((inverses[:, 2, 0] == 0).all() and (inverses[:, 2, 1] == 0).all() and (inverses[:, 2, 2] == 1).all())
+
+
+def _projective_terms(inverses, left, top, width, height):
+    """
+    输出区域 [left, left + width) x [top, top + height) 各像素中心的齐次坐标分量 (x', y', w)
+    矩阵对坐标是线性的：先算行、列两个一维分量再广播相加；仿射矩阵（最后一行为 0, 0, 1）的 w 为 None
+    """
+    # 输出像素中心（整数坐标，与 cv2.warpPerspective 一致）
+    xs = torch.arange(left, left + width, dtype=torch.float64)[None, None, :]
+    ys = torch.arange(top, top + height, dtype=torch.float64)[None, :, None]
+    m = inverses[:, :, :, None, None]
+
+    def linear(row):
+        return m[:, row, 0] * xs + (m[:, row, 1] * ys + m[:, row, 2])
+
+    if _is_affine(inverses):
+        return linear(0), linear(1), None
+    denom = linear(2)
+    denom = torch.where(denom.abs() < 1e-12, torch.full_like(denom, float("nan")), denom)
+    return linear(0), linear(1), denom
+
+
+def _source_coords(inverses, left, top, width, height):
+    """
+    输出区域各像素中心经 inverses 映射后的坐标
+    inverses: [N, 3, 3] float64 tensor；返回 (sx, sy)，均为 [N, height, width] float64，
+    映射到无穷远/背面的点为 NaN
+    """
+    sx, sy, denom = _projective_terms(inverses, left, top, width, height)
+    if denom is None:
+        return sx, sy
+    return sx / denom, sy / denom
+
+
+def footprint_levels(inverses, left, top, width, height):
+    """
+    输出像素在原图上的覆盖范围对应的 mipmap 层级 log2(rho)，[N, height, width] float32
+    rho 为映射雅可比矩阵两列长度的较大者（输出移动一个像素时原图上移动的距离）；放大处为 0
+    仿射矩阵的层级处处相同，只算一次再扩展
+    """
+    inverses = torch.as_tensor(np.asarray(inverses, dtype=np.float64).reshape(-1, 3, 3))
+    m = inverses[:, :, :, None, None]
+    sx, sy, denom = _projective_terms(inverses, left, top, width, height)
+    if denom is None:
+        du_dx, du_dy, dv_dx, dv_dy = m[:, 0, 0], m[:, 0, 1], m[:, 1, 0], m[:, 1, 1]
+    else:
+        # 商的求导：d(x'/w)/dx = (m00 - u * m20) / w
+        u, v = sx / denom, sy / denom
+        du_dx = (m[:, 0, 0] - u * m[:, 2, 0]) / denom
+        du_dy = (m[:, 0, 1] - u * m[:, 2, 1]) / denom
+        dv_dx = (m[:, 1, 0] - v * m[:, 2, 0]) / denom
+        dv_dy = (m[:, 1, 1] - v * m[:, 2, 1]) / denom
+    rho = torch.maximum(torch.hypot(du_dx, dv_dx), torch.hypot(du_dy, dv_dy))
+    levels = torch.nan_to_num(torch.log2(rho), nan=0.0, posinf=0.0, neginf=0.0).clamp_(0, MIPMAP_MAX_LEVELS)
+    return levels.float().expand(inverses.shape[0], height, width)
+
+
+def build_grids(inverses, width, height, source_size):
+    """
+    批量构建采样网格 [N, H, W, 2]（grid_sample 归一化坐标）
+    inverses: [N, 3, 3] 输出 -> 原图 的单应矩阵；按帧分块在 float64 下计算
+    """
+    source_width, source_height = source_size
+    # grid_sample(align_corners=False) 的归一化坐标：像素 i 的中心为 (2i + 1) / N - 1，直接并入矩阵
+    normalize = torch.tensor([
+        [2.0 / source_width, 0.0, 1.0 / source_width - 1.0],
+        [0.0, 2.0 / source_height, 1.0 / source_height - 1.0],
+        [0.0, 0.0, 1.0],
+    ], dtype=torch.float64)
+    inverses = normalize @ torch.from_numpy(np.asarray(inverses, dtype=np.float64).reshape(-1, 3, 3))
+    count = inverses.shape[0]
+    grids = torch.empty((count, height, width, 2), dtype=torch.float32)
+
+    frames_per_chunk = max(1, _GRID_CHUNK // max(1, width * height))
+    for start in range(0, count, frames_per_chunk):
+        gx, gy = _source_coords(inverses[start:start + frames_per_chunk], 0, 0, width, height)
+        target = grids[start:start + frames_per_chunk]
+        target[..., 0] = gx
+        target[..., 1] = gy
+    # 映射到无穷远/背面的点标记为界外
+    return torch.nan_to_num_(grids, nan=-4.0, posinf=-4.0, neginf=-4.0)
+
+
+def _cached_grid(matrix_key, width, height, source_size):
+    key = ("grid", matrix_key, width, height, source_size)
+    grid = _grid_cache.get(key)
+    if grid is None:
+        grid = build_grids(np.array(matrix_key, dtype=np.float64).reshape(1, 3, 3), width, height, source_size)
+        _grid_cache.put(key, grid)
+    return grid
+
+
+def _cached_levels(matrix_key, width, height):
+    key = ("levels", matrix_key, width, height)
+    levels = _grid_cache.get(key)
+    if levels is None:
+        levels = footprint_levels(np.array(matrix_key, dtype=np.float64).reshape(1, 3, 3), 0, 0, width, height)
+        _grid_cache.put(key, levels)
+    return levels
+
+
+def use_tiles(width, height):
+    """输出是否按块生成（面积超过 4 块，默认即原来的 2048 x 2048 上限）"""
+    return width * height > 4 * WARP_TILE_SIZE * WARP_TILE_SIZE
+
+
+def warp_perspective(images, inverse, width, height, mode="bilinear", fill_color="black", antialias=False):
+    """
+    对 IMAGE 批次 [B, H, W, C] 做透视变换，整个批次一次 grid_sample 完成
+    inverse: 输出 -> 原图 的单应矩阵 (3x3)
+    界外区域按 fill_color 填充；边缘与 cv2 BORDER_CONSTANT 一样与填充色按权重混合
+    antialias=True 时缩小的区域从 mipmap 金字塔的对应层级采样（层间线性混合），避免混叠
+    返回 float32 [B, height, width, 3]（transparent 时为 [B, height, width, 4]）
+    """
+    if images.device.type != "cpu":
+        images = images.cpu()
+    batch, source_height, source_width, channels = images.shape
+    if use_tiles(width, height):
+        return warp_perspective_tiled(images, np.asarray(inverse)[None], width, height, mode, fill_color,
+                                      antialias=antialias)
+    key = _grid_cache_key(inverse, width, height, (source_width, source_height))
+    grid = _cached_grid(*key)
+    if antialias:
+        levels = _cached_levels(*key[:3])
+        if levels.max() > 0:
+            return sample_mipmapped(images, grid, levels, mode, fill_color)
+    return sample_with_fill(images, grid.expand(batch, -1, -1, -1), mode, fill_color)
+
+
+def warp_perspective_sequence(images, inverses, width, height, mode="bilinear", fill_color="black", padding_mode="zeros",
+                              antialias=False):
+    """
+    逐帧不同单应矩阵的透视变换：inverses 为 [B, 3, 3]（第 i 帧 输出 -> 原图）
+    网格批量构建、批量 grid_sample；长序列按帧分块，网格内存与帧数无关
+    padding_mode="border" 时界外按边缘像素延伸、不混合填充色（输出完全落在原图内时使用）
+    """
+    if images.device.type != "cpu":
+        images = images.cpu()
+    inverses = np.asarray(inverses, dtype=np.float64).reshape(-1, 3, 3)
+    tiled = use_tiles(width, height)
+
+    def warp_chunk(frames, chunk_inverses):
+        if tiled:
+            return warp_perspective_tiled(frames, chunk_inverses, width, height, mode, fill_color,
+                                          padding_mode=padding_mode, antialias=antialias)
+        grids = build_grids(chunk_inverses, width, height, (frames.shape[2], frames.shape[1]))
+        if antialias:
+            levels = footprint_levels(chunk_inverses, 0, 0, width, height)
+            if levels.max() > 0:
+                return sample_mipmapped(frames, grids, levels, mode, fill_color, padding_mode)
+        return sample_with_fill(frames, grids, mode, fill_color, padding_mode)
+
+    frames_per_chunk = max(1, _GRID_CHUNK // (WARP_TILE_SIZE * WARP_TILE_SIZE if tiled else width * height))
+    if images.shape[0] <= frames_per_chunk:
+        return warp_chunk(images, inverses)
+
+    out = torch.empty((images.shape[0], height, width, 4 if fill_color == "transparent" else 3), dtype=torch.float32)
+    for start in range(0, images.shape[0], frames_per_chunk):
+        stop = start + frames_per_chunk
+        out[start:stop] = warp_chunk(images[start:stop], inverses[start:stop])
+    return out
+
+
+# grid_sample 双三次插值使用的系数（与 PyTorch 实现一致）
+_CUBIC_A = -0.75
+
+
+def _tap_weights(frac, mode):
+    """每个采样点在单个坐标轴上的插值权重，返回 [(偏移, 权重), ...]"""
+    if mode == "bicubic":
+        a = _CUBIC_A
+        t1 = frac + 1.0
+        w_m1 = ((a * t1 - 5.0 * a) * t1 + 8.0 * a) * t1 - 4.0 * a
+        w_0 = ((a + 2.0) * frac - (a + 3.0)) * frac * frac + 1.0
+        t2 = 1.0 - frac
+        w_1 = ((a + 2.0) * t2 - (a + 3.0)) * t2 * t2 + 1.0
+        return [(-1, w_m1), (0, w_0), (1, w_1), (2, 1.0 - w_m1 - w_0 - w_1)]
+    return [(0, 1.0 - frac), (1, frac)]
+
+
+def _axis_coverage(coord, size, mode):
+    """单个坐标轴上落在图像内的插值权重之和（界外采样点按 0 填充时的覆盖率）"""
+    base = torch.floor(coord)
+    frac = coord - base
+    coverage = torch.zeros_like(coord)
+    for offset, weight in _tap_weights(frac, mode):
+        index = base + offset
+        coverage += weight * ((index >= 0) & (index <= size - 1))
+    return coverage
+
+
+def _tap_range(coords, size, mode):
+    """坐标（像素）覆盖的插值采样点下标范围 [start, stop)，已裁到 [0, size)；没有界内采样点时返回 None"""
+    low = torch.nan_to_num(coords, nan=math.inf, neginf=math.inf).min().item()
+    high = torch.nan_to_num(coords, nan=-math.inf, posinf=-math.inf).max().item()
+    if not (math.isfinite(low) and math.isfinite(high)):
+        return None
+    reach = 2 if mode == "bicubic" else 1
+    start = max(0, int(math.floor(low)) - reach + 1)
+    stop = min(size, int(math.floor(high)) + reach + 1)
+    return (start, stop) if start < stop else None
+
+
+def warp_perspective_tiled(images, inverses, width, height, mode="bilinear", fill_color="black", tile_size=None,
+                           padding_mode="zeros", antialias=False):
+    """
+    分块透视变换：输出按 tile_size 分块生成，峰值内存只与块大小有关，适合 16K 级输出
+    每块只对其反向映射覆盖的原图区域（插值采样点的包围盒，原图上的视图，不复制）采样；
+    每个输出像素的采样位置与覆盖率都按整图坐标计算，与不分块的结果一致，块之间没有接缝
+    inverses: [1, 3, 3]（所有帧共用）或 [B, 3, 3]（逐帧）
+    antialias=True 时，有缩小的块改为从（整图只构建一次的）mipmap 金字塔采样
+    """
+    tile_size = tile_size or WARP_TILE_SIZE
+    batch, source_height, source_width, _ = images.shape
+    inverses = torch.from_numpy(np.asarray(inverses, dtype=np.float64).reshape(-1, 3, 3))
+    rgb = _as_rgb(images)
+    pyramid = None
+
+    transparent = fill_color == "transparent"
+    fill = torch.tensor(FILL_COLORS.get(fill_color, FILL_COLORS["black"]), dtype=torch.float32)
+    out = torch.empty((batch, height, width, 4 if transparent else 3), dtype=torch.float32)
+
+    for top in range(0, height, tile_size):
+        for left in range(0, width, tile_size):
+            tile_h, tile_w = min(tile_size, height - top), min(tile_size, width - left)
+            target = out[:, top:top + tile_h, left:left + tile_w]
+            sx, sy = _source_coords(inverses, left, top, tile_w, tile_h)
+            levels = footprint_levels(inverses, left, top, tile_w, tile_h) if antialias else None
+            if levels is not None and levels.max() > 0:
+                if pyramid is None:
+                    pyramid = cached_pyramid(images, rgb, MIPMAP_MAX_LEVELS)
+                grid = torch.stack([(2.0 * sx + 1.0) / source_width - 1.0,
+                                    (2.0 * sy + 1.0) / source_height - 1.0], dim=-1).float()
+                grid = torch.nan_to_num_(grid, nan=-4.0, posinf=-4.0, neginf=-4.0)
+                target[...] = sample_mipmapped(images, grid, levels, mode, fill_color, padding_mode, pyramid)
+                continue
+            x_range = _tap_range(sx, source_width, mode)
+            y_range = _tap_range(sy, source_height, mode)
+            sx = torch.nan_to_num(sx, nan=_OUTSIDE, posinf=_OUTSIDE, neginf=_OUTSIDE)
+            sy = torch.nan_to_num(sy, nan=_OUTSIDE, posinf=_OUTSIDE, neginf=_OUTSIDE)
+            if padding_mode == "border":
+                alpha = torch.ones((batch, tile_h, tile_w, 1), dtype=torch.float32)
+            else:
+                alpha = (_axis_coverage(sx, source_width, mode) * _axis_coverage(sy, source_height, mode)).unsqueeze(-1)
+                alpha = alpha.float().clamp_(0, 1).expand(batch, -1, -1, -1)
+
+            if x_range is None or y_range is None:
+                # 整块落在原图之外
+                target[..., :3] = 0 if transparent else fill
+            else:
+                (x0, x1), (y0, y1) = x_range, y_range
+                region = rgb[:, y0:y1, x0:x1]
+                # 相对原图子区域的归一化坐标；子区域之外的采样点同样在整图之外，按 0 填充
+                grid = torch.stack([(2.0 * (sx - x0) + 1.0) / (x1 - x0) - 1.0,
+                                    (2.0 * (sy - y0) + 1.0) / (y1 - y0) - 1.0], dim=-1).float()
+                if grid.shape[0] != batch:
+                    grid = grid.expand(batch, -1, -1, -1)
+                sampled = F.grid_sample(region.permute(0, 3, 1, 2), grid, mode=mode,
+                                        padding_mode=padding_mode, align_corners=False)
+                target[..., :3] = sampled.permute(0, 2, 3, 1)
+                if not transparent and fill.any():
+                    target[..., :3] += (1.0 - alpha) * fill
+            if transparent:
+                target[..., 3:] = alpha
+    return out.clamp_(0, 1)
+
+
+def grid_coverage(grid, source_size, mode="bilinear"):
+    """
+    采样网格 [B, H, W, 2] 上每个输出像素的覆盖率 [B, H, W, 1]（1 表示完全落在原图内）
+    插值核可分离，覆盖率等于两个坐标轴的覆盖率之积，只需在输出网格上计算
+    """
+    source_width, source_height = source_size
+    # 归一化坐标 -> 像素坐标（align_corners=False）
+    x = ((grid[..., 0] + 1.0) * source_width - 1.0) * 0.5
+    y = ((grid[..., 1] + 1.0) * source_height - 1.0) * 0.5
+    return (_axis_coverage(x, source_width, mode) * _axis_coverage(y, source_height, mode)).unsqueeze(-1)
+
+
+def _edge_coverage(points, source_size, mode="bilinear"):
+    """
+    采样点 [B, N, 2]（归一化坐标）的覆盖率 [B, N]：离图像边缘 3 个像素以上的点插值核完全落在图内，
+    覆盖率直接为 1，只对边缘附近（及界外）的点计算
+    """
+    limit = 1.0 - 6.0 / torch.tensor(source_size, dtype=points.dtype)
+    edge = (points.abs() > limit).any(dim=-1)
+    coverage = torch.ones(points.shape[:2], dtype=torch.float32)
+    if edge.any():
+        coverage[edge] = grid_coverage(points[edge][None, None], source_size, mode)[0, 0, :, 0].float().clamp_(0, 1)
+    return coverage
+
+
+def _as_rgb(images):
+    """[B, H, W, C] -> float32 RGB 视图（单通道扩展，RGBA 丢弃 alpha；float32 输入不复制）"""
+    rgb = images[..., :3] if images.shape[-1] >= 3 else images.expand(-1, -1, -1, 3)
+    if rgb.dtype != torch.float32:
+        rgb = rgb.float() / 255.0 if rgb.dtype == torch.uint8 else rgb.float()
+    return rgb
+
+
+def _composite(color, alpha, fill_color):
+    """
+    采样结果（界外按 0 计入，相当于预乘了覆盖率）与填充色合成
+    color: [B, H, W, 3]，alpha: [1 或 B, H, W, 1]
+    """
+    if fill_color == "transparent":
+        return torch.cat([color, alpha.expand(color.shape[0], -1, -1, -1)], dim=-1).clamp_(0, 1)
+    out = color.contiguous()
+    fill = torch.tensor(FILL_COLORS.get(fill_color, FILL_COLORS["black"]), dtype=torch.float32)
+    if fill.any():
+        out += (1.0 - alpha) * fill
+    return out.clamp_(0, 1)
+
+
+def sample_with_fill(images, grid, mode="bilinear", fill_color="black", padding_mode="zeros"):
+    """
+    按网格采样 [B, H, W, C] 并处理填充色
+    直接对通道在后的视图采样（不复制原图）；界外权重 = 1 - 覆盖率，据此混合填充色或作为 alpha 输出
+    padding_mode="border" 时界外按边缘像素延伸，覆盖率视为 1
+    """
+    rgb = _as_rgb(images)
+    sampled = F.grid_sample(rgb.permute(0, 3, 1, 2), grid, mode=mode, padding_mode=padding_mode, align_corners=False)
+    color = sampled.permute(0, 2, 3, 1)
+    if padding_mode == "border":
+        alpha = torch.ones((1,) + tuple(grid.shape[1:3]) + (1,), dtype=torch.float32)
+    else:
+        alpha = grid_coverage(grid[:1] if grid.stride(0) == 0 else grid, (images.shape[2], images.shape[1]), mode).clamp_(0, 1)
+    return _composite(color, alpha, fill_color)
+
+
+def build_pyramid(rgb, levels):
+    """
+    mipmap 金字塔：[B, H, W, 3] 的 RGB 图像逐层面积平均缩小一半（奇数边向上取整，覆盖范围不变）
+    返回各层通道在前的 [B, 3, h, w]，第 0 层为原图视图（不复制）；缩到 1x1 或达到 levels 层为止
+    偶数边长时 2x2 平均池化与面积插值结果相同，但快得多
+    """
+    pyramid = [rgb.permute(0, 3, 1, 2)]
+    for _ in range(levels):
+        height, width = pyramid[-1].shape[-2:]
+        if height == 1 and width == 1:
+            break
+        if height % 2 == 0 and width % 2 == 0:
+            pyramid.append(F.avg_pool2d(pyramid[-1], 2))
+        else:
+            pyramid.append(F.interpolate(pyramid[-1], size=((height + 1) // 2, (width + 1) // 2), mode="area"))
+    return pyramid
+
+
+def cached_pyramid(images, rgb, levels):
+    """
+    按输入内容指纹缓存的 build_pyramid（只缓存第 1 层及以上，第 0 层总是当前输入的视图；总量受 BB_PYRAMID_CACHE_MB 限制）
+    已缓存的金字塔层数足够时直接复用
+    """
+    key = tensor_content_hash(images)
+    cached = _pyramid_cache.get(key)
+    if cached is not None and (len(cached) >= levels or not cached or cached[-1].shape[-2:] == (1, 1)):
+        return [rgb.permute(0, 3, 1, 2)] + cached[:levels]
+
+    pyramid = build_pyramid(rgb, levels)
+    _pyramid_cache.put(key, pyramid[1:])
+    return pyramid
+
+
+def sample_mipmapped(images, grid, levels, mode="bilinear", fill_color="black", padding_mode="zeros", pyramid=None):
+    """
+    按像素覆盖范围从 mipmap 金字塔采样（层间线性混合，即三线性过滤），缩小时不产生混叠
+    grid: [1 或 B, H, W, 2] 归一化坐标（与分辨率无关，各层共用）；levels: [1 或 B, H, W] 层级
+    每一层只对用到该层的像素采样：放大处只采样原图一次，缩小处采样相邻两层
+    覆盖率按各层尺寸分别计算并同样混合，与界外按 0 计入的颜色保持一致（边缘不会出现暗边）
+    """
+    rgb = _as_rgb(images)
+    batch = images.shape[0]
+    if grid.shape[0] != levels.shape[0] or grid.stride(0) == 0:
+        grid, levels = grid[:1], levels[:1]
+    top = int(math.ceil(levels.max().item()))
+    if pyramid is None:
+        pyramid = cached_pyramid(images, rgb, top)
+    top = min(top, len(pyramid) - 1)
+
+    frames, height, width = levels.shape
+    levels = levels.clamp(max=top).reshape(frames, -1)
+    base = torch.floor(levels)
+    frac = levels - base
+    points = grid.reshape(frames, -1, 2)
+
+    color = torch.zeros((batch, 3, height * width), dtype=torch.float32)
+    alpha = torch.ones((frames, height * width), dtype=torch.float32) if padding_mode == "border" else \
+        torch.zeros((frames, height * width), dtype=torch.float32)
+    for level in range(top + 1):
+        weight = torch.where(base == level, 1.0 - frac, 0.0) + torch.where(base == level - 1, frac, 0.0)
+        used = (weight > 0).any(dim=0)
+        count = int(used.sum())
+        if count == 0:
+            continue
+        # 大部分像素都用到该层时整幅采样，省去收集 / 写回
+        index = slice(None) if 2 * count > used.numel() else torch.nonzero(used).flatten()
+        level_grid = points[:, index][:, None]
+        level_weight = weight[:, index]
+        sampled = F.grid_sample(pyramid[level], level_grid.expand(batch, -1, -1, -1), mode=mode,
+                                padding_mode=padding_mode, align_corners=False)[:, :, 0]
+        color[:, :, index] += sampled * level_weight[:, None]
+        if padding_mode != "border":
+            level_size = (pyramid[level].shape[-1], pyramid[level].shape[-2])
+            alpha[:, index] += _edge_coverage(level_grid[:, 0], level_size, mode) * level_weight
+
+    color = color.view(batch, 3, height, width).permute(0, 2, 3, 1)
+    return _composite(color, alpha.view(frames, height, width, 1), fill_color)